@@ -4,10 +4,21 @@ from sqeleton.abcs import DbTime, DbPath
 
 from .tracking import disable_tracking
 from .databases import connect
-from .diff_tables import Algorithm
-from .hashdiff_tables import HashDiffer, DEFAULT_BISECTION_THRESHOLD, DEFAULT_BISECTION_FACTOR
+from .diff_tables import Algorithm, Scheduling
+from .hashdiff_tables import (
+    HashDiffer,
+    BisectionTuner,
+    ConcurrencyController,
+    DEFAULT_BISECTION_THRESHOLD,
+    DEFAULT_BISECTION_FACTOR,
+    DEFAULT_MAX_CONCURRENCY,
+)
 from .joindiff_tables import JoinDiffer, TABLE_WRITE_LIMIT
+from .async_diff import AsyncHashDiffer, diff_tables_async
 from .table_segment import TableSegment
+from .checksum_cache import ChecksumCache
+from .journal import DiffJournal
+from .sharding import merge_shard_stats
 from .utils import eval_name_template, Vector
 
 
@@ -61,6 +72,8 @@ def diff_tables(
     # Maximum size of each threadpool. None = auto. Only relevant when threaded is True.
     # There may be many pools, so number of actual threads can be a lot higher.
     max_threadpool_size: Optional[int] = 1,
+    # Maximum number of diff rows to buffer for the consumer, before the threads wait for it. None = unbounded.
+    max_buffered_rows: Optional[int] = None,
     # Algorithm
     algorithm: Algorithm = Algorithm.AUTO,
     # An additional 'where' expression to restrict the search space.
@@ -69,6 +82,42 @@ def diff_tables(
     bisection_factor: int = DEFAULT_BISECTION_FACTOR,
     # When should we stop bisecting and compare locally (in row count; hashdiff only)
     bisection_threshold: int = DEFAULT_BISECTION_THRESHOLD,
+    # When should we stop bisecting and compare locally (in estimated bytes; overrides bisection_threshold; hashdiff only)
+    download_byte_budget: int = None,
+    # Checksum all the segments of a bisection step in a single query per table (hashdiff only)
+    bucketed_checksums: bool = False,
+    # Place the bisection checkpoints at the quantiles of a sample of the keys (hashdiff only)
+    quantile_checkpoints: bool = False,
+    # Choose the bisection factor and threshold at runtime, according to the observed performance (hashdiff only)
+    auto_bisection: bool = False,
+    # Adapt the number of checksum queries in flight to each database at runtime (hashdiff only)
+    adaptive_concurrency: bool = False,
+    # Highest number of checksum queries in flight to each database, with adaptive_concurrency (hashdiff only)
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    # In which order to diff the segments of the bisection (hashdiff only)
+    scheduling: Scheduling = Scheduling.DEPTH_FIRST,
+    # Compare big downloaded segments in this many worker processes, instead of in the query threads (hashdiff only)
+    comparison_processes: int = None,
+    # Compare downloaded segments with a streaming merge-join, ordered by key (hashdiff only)
+    sorted_merge: bool = False,
+    # Stream downloaded segments from a database cursor, in batches of this many rows (hashdiff only)
+    fetch_batch_size: int = None,
+    # Split compound integer keys in lexicographic order, so each segment is one index range scan (hashdiff only)
+    lexicographic_segments: bool = False,
+    # Download a hash of each row, and then only the rows whose hashes differ (hashdiff only)
+    hash_then_fetch: bool = False,
+    # Download segments as Arrow tables, and compare them with vectorized operations (hashdiff only)
+    arrow_fetch: bool = False,
+    # Path of a local file to cache segment checksums in, to be reused by later diffs (hashdiff only)
+    checksum_cache: str = None,
+    # Path of a local file to record completed segments in, so an interrupted diff can be resumed (hashdiff only)
+    journal: str = None,
+    # Skip the segments that are already completed in the journal, instead of starting over (hashdiff only)
+    resume: bool = False,
+    # Split the key space into this many shards, and diff only the shard `shard_index` (hashdiff only)
+    shard_count: int = None,
+    # Which shard to diff, from 0 to shard_count-1 (hashdiff only)
+    shard_index: int = None,
     # Enable/disable validating that the key columns are unique. (joindiff only)
     validate_unique_key: bool = True,
     # Enable/disable sampling of exclusive rows. Creates a temporary table. (joindiff only)
@@ -95,11 +144,70 @@ def diff_tables(
         max_threadpool_size (int): Maximum size of each threadpool. ``None`` means auto.
                                    Only relevant when `threaded` is ``True``.
                                    There may be many pools, so number of actual threads can be a lot higher.
+        max_buffered_rows (int, optional): Maximum number of diff rows to buffer for the consumer. When reached,
+                                           the diffing threads wait until the consumer catches up, which keeps
+                                           memory use bounded when the consumer is slow. ``None`` means unbounded.
         where (str, optional): An additional 'where' expression to restrict the search space.
         algorithm (:class:`Algorithm`): Which diffing algorithm to use (`HASHDIFF` or `JOINDIFF`. Default=`AUTO`)
         bisection_factor (int): Into how many segments to bisect per iteration. (Used when algorithm is `HASHDIFF`)
         bisection_threshold (Number): Minimal row count of segment to bisect, otherwise download
                                       and compare locally. (Used when algorithm is `HASHDIFF`).
+        download_byte_budget (int, optional): Maximal estimated size in bytes of a segment to download and compare
+                                              locally, instead of the row count of `bisection_threshold`. The row
+                                              size is estimated from the column types, and refined as rows are
+                                              downloaded. (Used when algorithm is `HASHDIFF`)
+        bucketed_checksums (bool): Checksum all the segments of a bisection step in a single GROUP BY query per table,
+                                   instead of a query per segment. (Used when algorithm is `HASHDIFF`. default: False)
+        quantile_checkpoints (bool): Place the bisection checkpoints at the quantiles of a random sample of the keys,
+                                     instead of spacing them evenly. Recommended for skewed or gappy keys.
+                                     (Used when algorithm is `HASHDIFF`. default: False)
+        auto_bisection (bool): Choose the bisection factor and threshold for each segment at runtime, according to
+                               the observed query latency, download speed and diff density. `bisection_factor` and
+                               `bisection_threshold` are used as the initial values.
+                               (Used when algorithm is `HASHDIFF`. default: False)
+        adaptive_concurrency (bool): Adapt the number of checksum queries in flight to each database at runtime,
+                                     raising it while the throughput improves, and backing off when the latency
+                                     rises or queries fail. Bounded by `max_concurrency`, and by the thread count
+                                     of each database. (Used when algorithm is `HASHDIFF`. default: False)
+        max_concurrency (int): Highest number of checksum queries in flight to each database, with
+                               `adaptive_concurrency`. The thread pools are raised to this size if they're smaller,
+                               and the controller decides how many of their threads query at once.
+                               (Used when algorithm is `HASHDIFF`. default: DEFAULT_MAX_CONCURRENCY)
+        scheduling (:class:`Scheduling`): In which order to diff the segments: `DEPTH_FIRST`, `BREADTH_FIRST` or
+                                          `MOST_SUSPICIOUS_FIRST`. (Used when algorithm is `HASHDIFF`.
+                                          default: `DEPTH_FIRST`)
+        comparison_processes (int, optional): Compare big downloaded segments in a pool of this many worker
+                                              processes, so that the comparison doesn't compete with the query
+                                              threads for the GIL. (Used when algorithm is `HASHDIFF`)
+        sorted_merge (bool): Download segments ordered by key, and compare them with a streaming merge-join, instead
+                             of building sets in memory. Only applies to numeric keys.
+                             (Used when algorithm is `HASHDIFF`. default: False)
+        fetch_batch_size (int, optional): Stream downloaded segments from a database cursor, `fetch_batch_size` rows
+                                          at a time, so memory use doesn't grow with `bisection_threshold`.
+                                          Implies `sorted_merge`. (Used when algorithm is `HASHDIFF`)
+        lexicographic_segments (bool): For compound integer keys, split the key space in lexicographic order, so that
+                                       each segment is a single range scan on a composite index of the key.
+                                       (Used when algorithm is `HASHDIFF`. default: False)
+        hash_then_fetch (bool): When downloading a segment, download only the key and a hash of each row, and
+                                then the full rows whose hashes differ. Cuts the transferred bytes for wide tables.
+                                (Used when algorithm is `HASHDIFF`. default: False)
+        arrow_fetch (bool): Download segments as Arrow tables, and compare them with vectorized operations, for
+                            databases whose driver supports it (DuckDB, Snowflake, BigQuery). Requires pyarrow.
+                            (Used when algorithm is `HASHDIFF`. default: False)
+        checksum_cache (str, optional): Path of a local SQLite file to cache segment checksums in. Later diffs of the
+                                        same tables will reuse them for segments whose row count and max(update_column)
+                                        haven't changed. Requires `update_column`. (Used when algorithm is `HASHDIFF`)
+        journal (str, optional): Path of a local SQLite file to record the completed segments in, with their row
+                                 counts and differences. (Used when algorithm is `HASHDIFF`)
+        resume (bool): Resume an interrupted diff from `journal`, skipping the segments it completed, and replaying
+                       their differences. Otherwise, the journal is cleared. Raises ValueError if the connections,
+                       tables, columns, `where` or update range differ from the journaled diff.
+                       (Used when algorithm is `HASHDIFF`. default: False)
+        shard_count (int, optional): Split the key space into this many shards, along its first column, and diff only
+                                     the shard `shard_index`. Running every shard covers the whole diff, and their
+                                     stats can be combined with :func:`merge_shard_stats`.
+                                     (Used when algorithm is `HASHDIFF`)
+        shard_index (int, optional): Which shard to diff, from 0 to `shard_count`-1. (Used when algorithm is `HASHDIFF`)
         validate_unique_key (bool): Enable/disable validating that the key columns are unique. (used for `JOINDIFF`. default: True)
                                     Single query, and can't be threaded, so it's very slow on non-cloud dbs.
                                     Future versions will detect UNIQUE constraints in the schema.
@@ -146,23 +254,50 @@ def diff_tables(
 
     segments = [t.new(**override_attrs) for t in tables] if override_attrs else tables
 
+    if resume and not journal:
+        raise ValueError("resume requires a journal")
+
     algorithm = Algorithm(algorithm)
     if algorithm == Algorithm.AUTO:
-        algorithm = Algorithm.JOINDIFF if table1.database is table2.database else Algorithm.HASHDIFF
+        same_database = table1.database is table2.database
+        algorithm = Algorithm.JOINDIFF if same_database and shard_count is None else Algorithm.HASHDIFF
 
     if algorithm == Algorithm.HASHDIFF:
+        if adaptive_concurrency and max_threadpool_size:
+            # Otherwise, there wouldn't be enough threads for the controller to raise the concurrency
+            max_threadpool_size = max(max_threadpool_size, max_concurrency)
         differ = HashDiffer(
             bisection_factor=bisection_factor,
             bisection_threshold=bisection_threshold,
+            download_byte_budget=download_byte_budget,
+            bucketed_checksums=bucketed_checksums,
+            quantile_checkpoints=quantile_checkpoints,
+            bisection_tuner=BisectionTuner() if auto_bisection else None,
+            concurrency_controller=ConcurrencyController(max_concurrency) if adaptive_concurrency else None,
+            scheduling=Scheduling(scheduling),
+            comparison_processes=comparison_processes,
+            sorted_merge=sorted_merge or bool(fetch_batch_size),
+            fetch_batch_size=fetch_batch_size,
+            lexicographic_segments=lexicographic_segments,
+            hash_then_fetch=hash_then_fetch,
+            arrow_fetch=arrow_fetch,
+            checksum_cache=ChecksumCache(checksum_cache) if checksum_cache else None,
+            journal=DiffJournal(journal, resume=resume) if journal else None,
+            shard_count=shard_count,
+            shard_index=shard_index,
             threaded=threaded,
             max_threadpool_size=max_threadpool_size,
+            max_buffered_rows=max_buffered_rows,
         )
     elif algorithm == Algorithm.JOINDIFF:
+        if shard_count is not None:
+            raise ValueError("shard_count is only supported by the HASHDIFF algorithm")
         if isinstance(materialize_to_table, str):
             materialize_to_table = table1.database.parse_table_name(eval_name_template(materialize_to_table))
         differ = JoinDiffer(
             threaded=threaded,
             max_threadpool_size=max_threadpool_size,
+            max_buffered_rows=max_buffered_rows,
             validate_unique_key=validate_unique_key,
             sample_exclusive_rows=sample_exclusive_rows,
             materialize_to_table=materialize_to_table,
@@ -15,10 +15,19 @@ from sqeleton.queries.api import current_timestamp
 
 from .dbt import dbt_diff
 from .utils import eval_name_template, remove_password_from_url, safezip, match_like
-from .diff_tables import Algorithm
-from .hashdiff_tables import HashDiffer, DEFAULT_BISECTION_THRESHOLD, DEFAULT_BISECTION_FACTOR
+from .diff_tables import Algorithm, Scheduling
+from .hashdiff_tables import (
+    HashDiffer,
+    BisectionTuner,
+    ConcurrencyController,
+    DEFAULT_BISECTION_THRESHOLD,
+    DEFAULT_BISECTION_FACTOR,
+)
 from .joindiff_tables import TABLE_WRITE_LIMIT, JoinDiffer
 from .table_segment import TableSegment
+from .checksum_cache import ChecksumCache
+from .journal import DiffJournal
+from .sharding import merge_shard_stats, get_merged_stats_string
 from .databases import connect
 from .parse_time import parse_time_before, UNITS_STR, ParseError
 from .config import apply_config_from_file
@@ -125,6 +134,128 @@ click.Context.formatter_class = MyHelpFormatter
     help=f"Minimal bisection threshold. Below it, data-diff will download the data and compare it locally. Default={DEFAULT_BISECTION_THRESHOLD}.",
     metavar="NUM",
 )
+@click.option(
+    "--download-byte-budget",
+    default=None,
+    type=int,
+    help="Download and compare segments locally once their estimated size is below this many bytes, "
+    "instead of using --bisection-threshold. Sizes are estimated from the column types. (hashdiff only)",
+    metavar="BYTES",
+)
+@click.option(
+    "--bucketed-checksums",
+    is_flag=True,
+    help="Checksum all the segments of a bisection step in a single query per table. (hashdiff only)",
+)
+@click.option(
+    "--quantile-checkpoints",
+    is_flag=True,
+    help="Split segments at the quantiles of a sample of the keys, instead of evenly. "
+    "Recommended when the keys are skewed or have big gaps. (hashdiff only)",
+)
+@click.option(
+    "--auto-bisection",
+    is_flag=True,
+    help="Choose the bisection factor and threshold for each segment at runtime, according to the observed "
+    "query latency and diff density. The --bisection-* options are used as initial values. (hashdiff only)",
+)
+@click.option(
+    "--adaptive-concurrency",
+    is_flag=True,
+    help="Adapt the number of checksum queries in flight to each database at runtime, raising it while the "
+    "throughput improves, and backing off when the latency rises or queries fail. --threads sets the upper bound. "
+    "(hashdiff only)",
+)
+@click.option(
+    "--scheduling",
+    default=Scheduling.DEPTH_FIRST.value,
+    type=click.Choice([i.value for i in Scheduling]),
+    help="In which order to diff the segments. 'depth-first' finds the first differences soonest, and uses the "
+    "least memory. 'breadth-first' runs the most queries in parallel. 'most-suspicious-first' starts with the "
+    "segments whose parent had the biggest difference in row count. (hashdiff only)",
+)
+@click.option(
+    "--comparison-processes",
+    default=None,
+    type=int,
+    help="Compare big downloaded segments in this many worker processes, so that the comparison doesn't compete "
+    "with the query threads for the GIL. (hashdiff only)",
+    metavar="COUNT",
+)
+@click.option(
+    "--sorted-merge",
+    is_flag=True,
+    help="Download segments ordered by key, and compare them with a streaming merge-join. "
+    "Only applies to numeric keys. (hashdiff only)",
+)
+@click.option(
+    "--fetch-batch-size",
+    default=None,
+    type=int,
+    help="Stream downloaded segments from a database cursor, this many rows at a time, "
+    "so memory use doesn't grow with --bisection-threshold. Implies --sorted-merge. (hashdiff only)",
+    metavar="NUM",
+)
+@click.option(
+    "--lexicographic-segments",
+    is_flag=True,
+    help="For compound integer keys, split segments in lexicographic order, "
+    "so that each one is a single range scan on a composite index of the key. (hashdiff only)",
+)
+@click.option(
+    "--hash-then-fetch",
+    is_flag=True,
+    help="When downloading a segment, download only the key and a hash of each row, "
+    "and then the full rows whose hashes differ. Recommended for wide tables. (hashdiff only)",
+)
+@click.option(
+    "--arrow-fetch",
+    is_flag=True,
+    help="Download segments as Arrow tables, and compare them with vectorized operations. "
+    "Only for DuckDB, Snowflake and BigQuery. Requires pyarrow. (hashdiff only)",
+)
+@click.option(
+    "--checksum-cache",
+    default=None,
+    help="Path of a local file to cache segment checksums in. Later runs will skip segments whose row count and "
+    "max(update_column) haven't changed. Requires --update-column. (hashdiff only)",
+    metavar="PATH",
+)
+@click.option(
+    "--journal",
+    default=None,
+    help="Path of a local file to record the completed segments in, with their differences, "
+    "so that the diff can be resumed if it's interrupted. (hashdiff only)",
+    metavar="PATH",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Resume an interrupted diff from --journal, skipping the segments it completed. (hashdiff only)",
+)
+@click.option(
+    "--shard-count",
+    default=None,
+    type=int,
+    help="Split the key space into this many shards, and diff only the shard --shard-index. "
+    "Running every shard, e.g. on different machines, covers the whole diff. (hashdiff only)",
+    metavar="COUNT",
+)
+@click.option(
+    "--shard-index",
+    default=None,
+    type=int,
+    help="Which shard to diff, from 0 to --shard-count minus 1. (hashdiff only)",
+    metavar="INDEX",
+)
+@click.option(
+    "--merge-shards",
+    default=[],
+    multiple=True,
+    help="Instead of diffing, merge the JSONL output of shard runs (--shard-count with --json) from this file. "
+    "Use once for each shard.",
+    metavar="PATH",
+)
 @click.option(
     "-m",
     "--materialize-to-table",
@@ -185,6 +316,14 @@ click.Context.formatter_class = MyHelpFormatter
     "'serial' guarantees a single-threaded execution of the algorithm (useful for debugging).",
     metavar="COUNT",
 )
+@click.option(
+    "--max-buffered-rows",
+    default=None,
+    type=int,
+    help="Maximum number of diff rows to buffer for the output. When reached, the diffing threads wait for "
+    "the output to catch up, so memory use stays bounded.",
+    metavar="NUM",
+)
 @click.option(
     "-w",
     "--where",
@@ -259,7 +398,9 @@ def main(conf, run, **kw):
         logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT, datefmt=DATE_FORMAT)
 
     try:
-        if kw["dbt"]:
+        if kw["merge_shards"]:
+            _merge_shards(kw["merge_shards"], kw["stats"], kw["json_output"])
+        elif kw["dbt"]:
             dbt_diff(
                 profiles_dir_override=kw["dbt_profiles_dir"],
                 project_dir_override=kw["dbt_project_dir"],
@@ -285,6 +426,24 @@ def _data_diff(
     algorithm,
     bisection_factor,
     bisection_threshold,
+    download_byte_budget,
+    bucketed_checksums,
+    quantile_checkpoints,
+    auto_bisection,
+    adaptive_concurrency,
+    scheduling,
+    comparison_processes,
+    sorted_merge,
+    fetch_batch_size,
+    lexicographic_segments,
+    hash_then_fetch,
+    arrow_fetch,
+    checksum_cache,
+    journal,
+    resume,
+    shard_count,
+    shard_index,
+    merge_shards,
     min_age,
     max_age,
     stats,
@@ -294,6 +453,7 @@ def _data_diff(
     interactive,
     no_tracking,
     threads,
+    max_buffered_rows,
     case_sensitive,
     json_output,
     where,
@@ -314,6 +474,10 @@ def _data_diff(
         logging.error("Cannot specify a limit when using the -s/--stats switch")
         return
 
+    if resume and not journal:
+        logging.error("Error: --resume requires --journal")
+        return
+
     key_columns = key_columns or ("id",)
     bisection_factor = DEFAULT_BISECTION_FACTOR if bisection_factor is None else int(bisection_factor)
     bisection_threshold = DEFAULT_BISECTION_THRESHOLD if bisection_threshold is None else int(bisection_threshold)
@@ -374,12 +538,17 @@ def _data_diff(
 
     algorithm = Algorithm(algorithm)
     if algorithm == Algorithm.AUTO:
-        algorithm = Algorithm.JOINDIFF if db1 == db2 else Algorithm.HASHDIFF
+        algorithm = Algorithm.JOINDIFF if db1 == db2 and shard_count is None else Algorithm.HASHDIFF
+
+    if algorithm == Algorithm.JOINDIFF and shard_count is not None:
+        logging.error("Error: --shard-count is only supported by hashdiff.")
+        return
 
     if algorithm == Algorithm.JOINDIFF:
         differ = JoinDiffer(
             threaded=threaded,
             max_threadpool_size=threads and threads * 2,
+            max_buffered_rows=max_buffered_rows,
             validate_unique_key=not assume_unique_key,
             sample_exclusive_rows=sample_exclusive_rows,
             materialize_all_rows=materialize_all_rows,
@@ -392,8 +561,30 @@ def _data_diff(
         differ = HashDiffer(
             bisection_factor=bisection_factor,
             bisection_threshold=bisection_threshold,
+            download_byte_budget=download_byte_budget,
+            bucketed_checksums=bucketed_checksums,
+            quantile_checkpoints=quantile_checkpoints,
+            bisection_tuner=BisectionTuner() if auto_bisection else None,
+            concurrency_controller=ConcurrencyController(max(threads1 or threads, threads2 or threads))
+            if adaptive_concurrency
+            else None,
+            scheduling=Scheduling(scheduling),
+            comparison_processes=comparison_processes,
+            sorted_merge=sorted_merge or bool(fetch_batch_size),
+            fetch_batch_size=fetch_batch_size,
+            lexicographic_segments=lexicographic_segments,
+            hash_then_fetch=hash_then_fetch,
+            arrow_fetch=arrow_fetch,
+            checksum_cache=ChecksumCache(checksum_cache) if checksum_cache else None,
+            journal=DiffJournal(journal, resume=resume) if journal else None,
+            shard_count=shard_count,
+            shard_index=shard_index,
+            threads1=threads1,
+            threads2=threads2,
             threaded=threaded,
-            max_threadpool_size=threads and threads * 2,
+            # Room for both databases to be busy, so that the faster one can work ahead
+            max_threadpool_size=(threads1 or threads) + (threads2 or threads),
+            max_buffered_rows=max_buffered_rows,
         )
 
     table_names = table1, table2
@@ -443,15 +634,17 @@ def _data_diff(
         for db, table_path, raw_schema in safezip(dbs, table_paths, schemas)
     ]
 
-    diff_iter = differ.diff_tables(*segments)
+    diff_result = diff_iter = differ.diff_tables(*segments)
 
     if limit:
         assert not stats
         diff_iter = islice(diff_iter, int(limit))
 
+    shard = None if shard_count is None else {"shard": [shard_index, shard_count]}
+
     if stats:
         if json_output:
-            rich.print(json.dumps(diff_iter.get_stats_dict()))
+            print(json.dumps({**(shard or {}), **diff_iter.get_stats_dict()}))
         else:
             rich.print(diff_iter.get_stats_string())
 
@@ -461,17 +654,62 @@ def _data_diff(
 
             if json_output:
                 jsonl = json.dumps([op, list(values)])
-                rich.print(f"[{color}]{jsonl}[/{color}]")
+                # Not wrapped, so that each record stays on its own line, e.g. for --merge-shards
+                rich.get_console().print(f"[{color}]{jsonl}[/{color}]", soft_wrap=True)
             else:
                 text = f"{op} {', '.join(map(str, values))}"
                 rich.print(f"[{color}]{text}[/{color}]")
 
             sys.stdout.flush()
 
+        # Stop any work still in progress, if we stopped at the limit
+        diff_result.close()
+
+        if shard and json_output and not limit:
+            # Lets --merge-shards combine the stats of all the shards
+            print(json.dumps({**shard, **diff_result.get_stats_dict()}))
+
+    differ.close()
+
     end = time.monotonic()
 
     logging.info(f"Duration: {end-start:.2f} seconds.")
 
 
+def _merge_shards(paths, stats, json_output):
+    """Prints the combined output of shard runs, from the JSONL files they printed
+
+    The diff rows are JSON lists, and the stats of each shard are a JSON object.
+    """
+    shard_stats = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if isinstance(item, dict):
+                    shard_stats.append(item)
+                elif not stats:
+                    op, values = item
+                    color = COLOR_SCHEME[op]
+                    if json_output:
+                        rich.get_console().print(f"[{color}]{json.dumps(item)}[/{color}]", soft_wrap=True)
+                    else:
+                        text = f"{op} {', '.join(map(str, values))}"
+                        rich.print(f"[{color}]{text}[/{color}]")
+
+    if not shard_stats:
+        if stats:
+            logging.error("Error: No shard stats found. Run the shards with --json, and without --limit.")
+        return
+
+    merged = merge_shard_stats(shard_stats)
+    if json_output:
+        print(json.dumps(merged))
+    else:
+        rich.print(get_merged_stats_string(merged))
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,93 @@
+"Fetching query results as Arrow tables, and comparing them column-wise"
+
+from typing import List, Tuple
+
+from sqeleton.databases import Database, DuckDB, Snowflake, BigQuery
+from sqeleton.queries import Expr, Compiler
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+    except ImportError:
+        raise RuntimeError("Could not import 'pyarrow' package. You can install it using: pip install 'data-diff[arrow]'.")
+
+    return pyarrow
+
+
+def supports_arrow(db: Database) -> bool:
+    "Returns whether the database driver can return query results as Arrow tables"
+    return isinstance(db, (DuckDB, Snowflake, BigQuery))
+
+
+def fetch_arrow(db: Database, expr: Expr):
+    "Run the query, and return its result as a pyarrow.Table"
+    pa = import_pyarrow()
+    sql_code = Compiler(db).compile(expr)
+
+    if isinstance(db, DuckDB):
+        # cursor() creates a new connection to the same database, which is safe to use from any thread
+        c = db._conn.cursor()
+        try:
+            return c.execute(sql_code).arrow()
+        finally:
+            c.close()
+
+    if isinstance(db, Snowflake):
+        c = db._conn.cursor()
+        try:
+            c.execute(sql_code)
+            res = c.fetch_arrow_all()
+            if res is None:
+                # No rows, and therefore no batches to take the schema from
+                return pa.table({d[0]: pa.array([], pa.string()) for d in c.description})
+            return res
+        finally:
+            c.close()
+
+    if isinstance(db, BigQuery):
+        return db._client.query(sql_code).to_arrow()
+
+    raise NotImplementedError(f"Arrow fetch isn't supported for {db.name}")
+
+
+def _row_ids(t):
+    """Encodes each row of the table as a single string, such that two rows are equal iff their encodings are.
+
+    Each value is prefixed by its length, so that the separator can't be confused with the values themselves,
+    and nulls are encoded as a bare marker, which can't be confused with a length prefix.
+    """
+    pa = import_pyarrow()
+    pc = pa.compute
+
+    parts = []
+    for col in t.columns:
+        col = pc.cast(col, pa.string())
+        encoded = pc.binary_join_element_wise(pc.cast(pc.utf8_length(col), pa.string()), col, ":")
+        parts.append(pc.fill_null(encoded, "N"))
+    return pc.binary_join_element_wise(*parts, "|")
+
+
+def _to_rows(t) -> list:
+    pa = import_pyarrow()
+    columns = [t.column(i).cast(pa.string()).to_pylist() for i in range(t.num_columns)]
+    return list(zip(*columns))
+
+
+def arrow_exclusive_rows(t1, t2) -> Tuple[List[tuple], List[tuple]]:
+    """Returns the rows of t1 that aren't in t2, and the rows of t2 that aren't in t1, as lists of tuples.
+
+    The tables must have the same number of columns. The rows are matched using vectorized operations,
+    so only the differing rows are converted into Python objects.
+    """
+    pa = import_pyarrow()
+    pc = pa.compute
+
+    assert t1.num_columns == t2.num_columns, (t1.schema, t2.schema)
+
+    ids1 = _row_ids(t1)
+    ids2 = _row_ids(t2)
+    only1 = t1.filter(pc.invert(pc.is_in(ids1, value_set=pc.unique(ids2))))
+    only2 = t2.filter(pc.invert(pc.is_in(ids2, value_set=pc.unique(ids1))))
+    return _to_rows(only1), _to_rows(only2)
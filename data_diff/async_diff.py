@@ -0,0 +1,199 @@
+"""Provides an asyncio interface for diffing tables, for applications that run many diffs concurrently
+"""
+
+import asyncio
+from concurrent.futures import Executor
+from typing import AsyncIterator, Optional, Tuple
+
+from runtype import dataclass
+
+from .info_tree import InfoTree, SegmentInfo
+from .hashdiff_tables import HashDiffer
+from .table_segment import TableSegment
+from .thread_utils import ThreadedYielder, PriorityThreadPoolExecutor, submit_with_priority
+
+AsyncDiffResult = AsyncIterator[Tuple[str, tuple]]  # AsyncIterator[Tuple[Literal["+", "-"], tuple]]
+
+
+class AsyncYielder(ThreadedYielder):
+    """A ThreadedYielder that is consumed with ``async for``, without blocking the event loop.
+
+    The tasks run on the given executor, which may be shared by many yielders.
+    """
+
+    def __init__(self, executor: Executor, max_buffered: Optional[int] = None):
+        super().__init__(max_buffered=max_buffered, executor=executor)
+        self._loop = None
+        self._wakeup = None
+
+    def _notify_consumer(self):
+        super()._notify_consumer()
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                pass  # The event loop is closed, so there's no one to wake up
+
+    async def __aiter__(self):
+        try:
+            while True:
+                with self._cond:
+                    if self._loop is None:
+                        self._loop = asyncio.get_running_loop()
+                        self._wakeup = asyncio.Event()
+
+                    self._taken = 0
+                    self._has_room.notify_all()
+
+                    if self._exception:
+                        raise self._exception
+
+                    items = list(self._yield)
+                    self._yield.clear()
+                    self._taken = len(items)
+                    if not items:
+                        if not self._pending:
+                            # No more tasks
+                            return
+                        # Cleared under the lock, so a notification can't be missed between the check and the wait
+                        self._wakeup.clear()
+
+                if not items:
+                    await self._wakeup.wait()
+                    continue
+
+                for item in items:
+                    yield item
+        finally:
+            if self._pending:
+                # Stopped before all the tasks were done
+                self.cancel()
+
+
+@dataclass
+class AsyncHashDiffer(HashDiffer):
+    """Finds the diff between two SQL tables, using the HashDiff algorithm, as an async iterator.
+
+    The bisection runs the same as in :class:`HashDiffer`, but its queries run on an executor,
+    while the event loop only awaits their results. Sharing one executor between concurrent diffs
+    bounds the number of queries in flight, and the number of threads, across all of them.
+
+    Accepts the same parameters as :class:`HashDiffer`, and:
+
+    Parameters:
+        executor (Executor, optional): The executor to run the queries on. If not provided, the differ
+                                       creates one, with `max_threadpool_size` threads, which is shut down
+                                       by :meth:`close`.
+        threaded (bool): Whether each task queries both tables at the same time, on threads of its own.
+                         (default: False, so that all the queries go through `executor`)
+    """
+
+    threaded: bool = False
+    executor: Optional[Executor] = None
+
+    _own_executor = None
+
+    def _get_executor(self) -> Executor:
+        "Returns `executor`, or else a pool of `max_threadpool_size` threads, created on first use and kept until close()"
+        if self.executor is not None:
+            return self.executor
+        if self._own_executor is None:
+            with self._task_pool_lock:
+                if self._own_executor is None:
+                    object.__setattr__(self, "_own_executor", PriorityThreadPoolExecutor(self.max_threadpool_size))
+        return self._own_executor
+
+    def close(self):
+        """Shut down the threads that were started for the diffs, including the executor that the differ created.
+
+        An `executor` that was provided isn't shut down.
+        """
+        super().close()
+        with self._task_pool_lock:
+            own_executor = self._own_executor
+            object.__setattr__(self, "_own_executor", None)
+        if own_executor is not None:
+            own_executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _new_yielder(self) -> ThreadedYielder:
+        return AsyncYielder(self._get_executor(), self.max_buffered_rows)
+
+    def _run(self, func, *args) -> asyncio.Future:
+        return asyncio.wrap_future(submit_with_priority(self._get_executor(), func, *args))
+
+    async def diff_tables_async(
+        self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree = None
+    ) -> AsyncDiffResult:
+        """Diff the given tables.
+
+        Parameters:
+            table1 (TableSegment): The "before" table to compare. Or: source table
+            table2 (TableSegment): The "after" table to compare. Or: target table
+            info_tree (InfoTree, optional): Collects the counts and statistics of the diffed segments.
+
+        Returns:
+            An async iterator that yields pair-tuples, the same as the iterator of :meth:`diff_tables`.
+        """
+        if info_tree is None:
+            info_tree = InfoTree(SegmentInfo([table1, table2]))
+
+        start = self._start_diff()
+        error = None
+        ti = None
+        try:
+            with self._diff_resources(table1, table2):
+                table1, table2 = await asyncio.gather(self._run(table1.with_schema), self._run(table2.with_schema))
+                self._validate_and_adjust_columns(table1, table2)
+
+                ti = await self._run(self._diff_tables_root, table1, table2, info_tree)
+                async for item in ti:
+                    yield item
+        except BaseException as e:
+            # Includes GeneratorExit and CancelledError, when the diff is closed or cancelled early
+            if ti is not None:
+                ti.cancel()
+            if not isinstance(e, (GeneratorExit, asyncio.CancelledError)):
+                error = e
+            raise
+        finally:
+            self._end_diff(table1, table2, info_tree, start, error)
+
+
+def diff_tables_async(
+    table1: TableSegment, table2: TableSegment, executor: Optional[Executor] = None, **kwargs
+) -> AsyncDiffResult:
+    """Finds the diff between table1 and table2, as an async iterator, using the HashDiff algorithm.
+
+    Parameters:
+        table1 (TableSegment): The "before" table to compare. Or: source table
+        table2 (TableSegment): The "after" table to compare. Or: target table
+        executor (Executor, optional): The executor to run the queries on. Share one between concurrent diffs,
+                                       to bound the number of queries in flight across all of them.
+        **kwargs: Options for :class:`AsyncHashDiffer`, e.g. `bisection_factor` or `bisection_threshold`.
+
+    Example:
+        >>> executor = ThreadPoolExecutor(16)
+        >>> async for sign, row in diff_tables_async(table1, table2, executor):
+        ...     print(sign, row)
+
+    Note:
+        sqeleton's drivers are all blocking, so the queries still run on threads. But their number is bounded by
+        the executor, instead of growing with the number of diffs.
+    """
+    return _diff_and_close(AsyncHashDiffer(executor=executor, **kwargs), table1, table2)
+
+
+async def _diff_and_close(differ: AsyncHashDiffer, table1: TableSegment, table2: TableSegment) -> AsyncDiffResult:
+    diff = differ.diff_tables_async(table1, table2)
+    try:
+        async for item in diff:
+            yield item
+    finally:
+        await diff.aclose()
+        differ.close()
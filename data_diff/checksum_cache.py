@@ -0,0 +1,142 @@
+"""Provides a persistent cache of segment checksums, for repeated diffs of the same tables
+"""
+
+import json
+import sqlite3
+import threading
+import weakref
+from typing import Optional, Tuple
+from uuid import uuid4
+
+from sqeleton.databases import Database
+
+from .table_segment import TableSegment
+
+# Connection parameters that tell apart the servers, databases and schemas that a table path may refer to.
+# Credentials are left out, so that they're never written to a local file.
+_IDENTITY_PARAMS = (
+    "host",
+    "port",
+    "account",
+    "server_hostname",
+    "http_path",
+    "dsn",
+    "filepath",
+    "project",
+    "catalog",
+    "database",
+    "dbname",
+    "dataset",
+    "schema",
+)
+
+_in_memory_database_ids = weakref.WeakKeyDictionary()
+
+
+def database_identity(db: Database) -> dict:
+    "Returns the parameters that identify the server and database of the connection, without its credentials"
+    params = getattr(db, "_args", None) or getattr(db, "kwargs", None) or {}
+    # Some databases (e.g. Snowflake, Presto, Trino) only keep their connection object, which has the same attributes
+    conn = getattr(db, "_conn", None)
+
+    identity = {"default_schema": getattr(db, "default_schema", None)}
+    for p in _IDENTITY_PARAMS:
+        value = params.get(p)
+        if value is None:
+            value = getattr(db, p, None)
+        if value is None and conn is not None:
+            value = getattr(conn, p, None)
+        if value is not None:
+            identity[p] = value
+
+    if identity.get("filepath") == ":memory:":
+        # An in-memory database only lives as long as its connection, so it can't be identified by its parameters
+        if db not in _in_memory_database_ids:
+            _in_memory_database_ids[db] = uuid4().hex
+        identity["connection"] = _in_memory_database_ids[db]
+
+    return identity
+
+
+def segment_key(table: TableSegment, side: int) -> str:
+    """Returns a string that identifies the rows of the segment, to be stored in a local file
+
+    `side` is 1 or 2, for the table1 or table2 of the diff.
+    """
+    key = [
+        side,
+        table.database.name,
+        database_identity(table.database),
+        table.table_path,
+        table.relevant_columns,
+        table.where,
+        table.min_key,
+        table.max_key,
+        table.min_update,
+        table.max_update,
+    ]
+    if table.is_lexicographic:
+        key += [table.lex_min, table.lex_max]
+    return json.dumps(key, default=str)
+
+
+class ChecksumCache:
+    """Stores the count and checksum of table segments in a local SQLite file, to be reused by later diffs.
+
+    Segments are identified by their side of the diff, the server and database of their connection, their table,
+    columns and bounds.
+
+    A cached checksum is reused only if the freshness probe of the segment, i.e. its row count and max(update_column),
+    is the same as when it was stored. That makes the cache only applicable to segments with an `update_column`.
+
+    Note:
+        Changes that affect neither the row count nor max(update_column), such as an update that doesn't
+        bump the update column, will not be detected for segments that are served from the cache.
+
+    Parameters:
+        path (str): Path of the SQLite file. Created if it doesn't exist.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS segment_checksums "
+                "(segment TEXT PRIMARY KEY, probe TEXT NOT NULL, count INTEGER NOT NULL, checksum TEXT)"
+            )
+
+    def get(
+        self, table: TableSegment, side: int, probe: Tuple[int, Optional[str]]
+    ) -> Optional[Tuple[int, Optional[int]]]:
+        "Returns the cached (count, checksum) of the segment, or None if it's missing or the probe doesn't match"
+        with self._lock:
+            res = self._conn.execute(
+                "SELECT probe, count, checksum FROM segment_checksums WHERE segment = ?", (segment_key(table, side),)
+            ).fetchone()
+
+        if res is None:
+            return None
+        cached_probe, count, checksum = res
+        if cached_probe != json.dumps(probe, default=str):
+            return None
+        return count, None if checksum is None else int(checksum)
+
+    def put(
+        self, table: TableSegment, side: int, probe: Tuple[int, Optional[str]], count: int, checksum: Optional[int]
+    ):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO segment_checksums (segment, probe, count, checksum) VALUES (?, ?, ?, ?)",
+                (
+                    segment_key(table, side),
+                    json.dumps(probe, default=str),
+                    count,
+                    None if checksum is None else str(checksum),
+                ),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
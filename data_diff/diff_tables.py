@@ -3,12 +3,13 @@
 
 import re
 import time
+import threading
 from abc import ABC, abstractmethod
 from enum import Enum
 from contextlib import contextmanager
 from operator import methodcaller
-from typing import Dict, Tuple, Iterator, Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple, Iterator, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 from runtype import dataclass
 
@@ -16,9 +17,11 @@ from data_diff.info_tree import InfoTree, SegmentInfo
 
 from .utils import run_as_daemon, safezip, getLogger, truncate_error, Vector
 from .thread_utils import ThreadedYielder
-from .table_segment import TableSegment, create_mesh_from_points
+from .query_utils import close_stream_connections
+from .table_segment import TableSegment, create_mesh_from_points, merge_adjacent_boxes, split_key_space
 from .tracking import create_end_event_json, create_start_event_json, send_event_json, is_tracking_enabled
 from sqeleton.abcs import IKey
+from sqeleton.databases import DbKey
 
 logger = getLogger(__name__)
 
@@ -29,22 +32,75 @@ class Algorithm(Enum):
     HASHDIFF = "hashdiff"
 
 
+class Scheduling(Enum):
+    """In which order to diff the segments of the bisection
+
+    - DEPTH_FIRST: Deeper segments first. Finds the first differences soonest, and buffers the fewest segments.
+    - BREADTH_FIRST: Shallower segments first. Has the most segments ready to run in parallel.
+    - MOST_SUSPICIOUS_FIRST: Segments whose parent had the biggest difference in row count first.
+    """
+
+    DEPTH_FIRST = "depth-first"
+    BREADTH_FIRST = "breadth-first"
+    MOST_SUSPICIOUS_FIRST = "most-suspicious-first"
+
+
 DiffResult = Iterator[Tuple[str, tuple]]  # Iterator[Tuple[Literal["+", "-"], tuple]]
 
 
+def _option_for_tracking(value):
+    "Make sure option values can be serialized, without reporting the contents of non-primitive objects"
+    if value is None or isinstance(value, (bool, int, float, str, list, tuple, dict)):
+        return value
+    return type(value).__name__
+
+
 @dataclass
 class ThreadBase:
     "Provides utility methods for optional threading"
 
     threaded: bool = True
     max_threadpool_size: Optional[int] = 1
+    max_buffered_rows: Optional[int] = None
+
+    _task_pool = None
+    _task_pool_lock = None
+
+    def __post_init__(self):
+        object.__setattr__(self, "_task_pool_lock", threading.Lock())
+
+    def _get_task_pool(self) -> ThreadPoolExecutor:
+        "Returns the pool that runs the calls of the methods below. It's created on first use, and reused after."
+        if self._task_pool is None:
+            with self._task_pool_lock:
+                if self._task_pool is None:
+                    # Every thread of the diff may be waiting on a call for each of the two tables
+                    max_workers = self.max_threadpool_size and self.max_threadpool_size * 2
+                    object.__setattr__(self, "_task_pool", ThreadPoolExecutor(max_workers=max_workers))
+        return self._task_pool
+
+    def close(self):
+        """Shut down the threads that were started for the diffs.
+
+        The differ may still be used after, in which case they are started again.
+        """
+        with self._task_pool_lock:
+            task_pool = self._task_pool
+            object.__setattr__(self, "_task_pool", None)
+        if task_pool is not None:
+            task_pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def _thread_map(self, func, iterable):
         if not self.threaded:
             return map(func, iterable)
 
-        with ThreadPoolExecutor(max_workers=self.max_threadpool_size) as task_pool:
-            return task_pool.map(func, iterable)
+        return list(self._get_task_pool().map(func, iterable))
 
     def _threaded_call(self, func, iterable):
         "Calls a method for each object in iterable."
@@ -55,10 +111,9 @@ class ThreadBase:
             yield from map(func, iterable)
             return
 
-        with ThreadPoolExecutor(max_workers=self.max_threadpool_size) as task_pool:
-            futures = [task_pool.submit(func, item) for item in iterable]
-            for future in as_completed(futures):
-                yield future.result()
+        futures = [self._get_task_pool().submit(func, item) for item in iterable]
+        for future in as_completed(futures):
+            yield future.result()
 
     def _threaded_call_as_completed(self, func, iterable):
         "Calls a method for each object in iterable. Returned in order of completion."
@@ -66,11 +121,27 @@ class ThreadBase:
 
     @contextmanager
     def _run_in_background(self, *funcs):
-        with ThreadPoolExecutor(max_workers=self.max_threadpool_size) as task_pool:
-            futures = [task_pool.submit(f) for f in funcs if f is not None]
+        funcs = [f for f in funcs if f is not None]
+        if not funcs:
+            yield []
+            return
+
+        # The background tasks may run for as long as the block, so they get threads of their own,
+        # rather than holding up the calls of the shared pool.
+        task_pool = ThreadPoolExecutor(max_workers=len(funcs))
+        futures = [task_pool.submit(f) for f in funcs]
+        try:
             yield futures
+        except BaseException:
+            # Includes GeneratorExit, when the diff is closed early. Only tasks that already started are awaited.
             for f in futures:
-                f.result()
+                f.cancel()
+            wait(futures)
+            raise
+        finally:
+            task_pool.shutdown(wait=False)
+        for f in futures:
+            f.result()
 
 
 @dataclass
@@ -82,6 +153,23 @@ class DiffStats:
     diff_percent: float
     extra_column_diffs: Optional[Dict[str, int]]
 
+    def get_stats_string(self, extra_info: dict = None) -> str:
+        string_output = ""
+        string_output += f"{self.table1_count} rows in table A\n"
+        string_output += f"{self.table2_count} rows in table B\n"
+        string_output += f"{self.diff_by_sign['-']} rows exclusive to table A (not present in B)\n"
+        string_output += f"{self.diff_by_sign['+']} rows exclusive to table B (not present in A)\n"
+        string_output += f"{self.diff_by_sign['!']} rows updated\n"
+        string_output += f"{self.unchanged} rows unchanged\n"
+        string_output += f"{100*self.diff_percent:.2f}% difference score\n"
+
+        if extra_info:
+            string_output += "\nExtra-Info:\n"
+            for k, v in sorted(extra_info.items()):
+                string_output += f"  {k} = {v}\n"
+
+        return string_output
+
 
 @dataclass
 class DiffResultWrapper:
@@ -96,6 +184,14 @@ class DiffResultWrapper:
             self.result_list.append(i)
             yield i
 
+    def close(self):
+        """Stop the diff, and cancel the work that is still pending.
+
+        Should be called when the diff isn't consumed to the end (e.g. after reaching a limit).
+        The results that were already found are kept.
+        """
+        self.diff.close()
+
     def _get_stats(self, is_dbt: bool = False) -> DiffStats:
         list(self)  # Consume the iterator into result_list, if we haven't already
 
@@ -153,20 +249,7 @@ class DiffResultWrapper:
                 string_output += f"\n{k}: {v}"
 
         else:
-
-            string_output = ""
-            string_output += f"{diff_stats.table1_count} rows in table A\n"
-            string_output += f"{diff_stats.table2_count} rows in table B\n"
-            string_output += f"{diff_stats.diff_by_sign['-']} rows exclusive to table A (not present in B)\n"
-            string_output += f"{diff_stats.diff_by_sign['+']} rows exclusive to table B (not present in A)\n"
-            string_output += f"{diff_stats.diff_by_sign['!']} rows updated\n"
-            string_output += f"{diff_stats.unchanged} rows unchanged\n"
-            string_output += f"{100*diff_stats.diff_percent:.2f}% difference score\n"
-
-            if self.stats:
-                string_output += "\nExtra-Info:\n"
-                for k, v in sorted(self.stats.items()):
-                    string_output += f"  {k} = {v}\n"
+            string_output = diff_stats.get_stats_string(self.stats)
 
         return string_output
 
@@ -188,6 +271,9 @@ class DiffResultWrapper:
 
 class TableDiffer(ThreadBase, ABC):
     bisection_factor = 32
+    scheduling = Scheduling.DEPTH_FIRST
+    shard_count = None
+    shard_index = None
     stats: dict = {}
 
     def diff_tables(self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree = None) -> DiffResultWrapper:
@@ -208,48 +294,69 @@ class TableDiffer(ThreadBase, ABC):
         return DiffResultWrapper(self._diff_tables_wrapper(table1, table2, info_tree), info_tree, self.stats)
 
     def _diff_tables_wrapper(self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree) -> DiffResult:
-        if is_tracking_enabled():
-            options = dict(self)
-            options["differ_name"] = type(self).__name__
-            event_json = create_start_event_json(options)
-            run_as_daemon(send_event_json, event_json)
-
-        start = time.monotonic()
+        start = self._start_diff()
         error = None
         try:
-            # Query and validate schema
-            table1, table2 = self._threaded_call("with_schema", [table1, table2])
-            self._validate_and_adjust_columns(table1, table2)
+            with self._diff_resources(table1, table2):
+                # Query and validate schema
+                table1, table2 = self._threaded_call("with_schema", [table1, table2])
+                self._validate_and_adjust_columns(table1, table2)
 
-            yield from self._diff_tables_root(table1, table2, info_tree)
+                yield from self._diff_tables_root(table1, table2, info_tree)
 
+        except GeneratorExit:
+            # The diff was closed before it was done. Not an error.
+            raise
         except BaseException as e:  # Catch KeyboardInterrupt too
             error = e
         finally:
-            info_tree.aggregate_info()
-
-            if is_tracking_enabled():
-                runtime = time.monotonic() - start
-                rowcounts = info_tree.info.rowcounts
-                table1_count = rowcounts[1] if rowcounts else None
-                table2_count = rowcounts[2] if rowcounts else None
-                diff_count = info_tree.info.diff_count
-                err_message = truncate_error(repr(error))
-                event_json = create_end_event_json(
-                    error is None,
-                    runtime,
-                    table1.database.name,
-                    table2.database.name,
-                    table1_count,
-                    table2_count,
-                    diff_count,
-                    err_message,
-                )
-                send_event_json(event_json)
+            self._end_diff(table1, table2, info_tree, start, error)
 
             if error:
                 raise error
 
+    def _start_diff(self) -> float:
+        "Reports the start of a diff, and returns its start time"
+        if is_tracking_enabled():
+            options = {k: _option_for_tracking(v) for k, v in dict(self).items()}
+            options["differ_name"] = type(self).__name__
+            event_json = create_start_event_json(options)
+            run_as_daemon(send_event_json, event_json)
+
+        return time.monotonic()
+
+    @contextmanager
+    def _diff_resources(self, table1: TableSegment, table2: TableSegment):
+        "Holds the resources that the diff of the given tables needs, for as long as the block runs"
+        yield
+
+    def _end_diff(
+        self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree, start: float, error: BaseException
+    ):
+        "Collects the stats of a diff that ended, releases its connections, and reports it"
+        info_tree.aggregate_info()
+        for db in (table1.database, table2.database):
+            close_stream_connections(db)
+
+        if is_tracking_enabled():
+            runtime = time.monotonic() - start
+            rowcounts = info_tree.info.rowcounts
+            table1_count = rowcounts[1] if rowcounts else None
+            table2_count = rowcounts[2] if rowcounts else None
+            diff_count = info_tree.info.diff_count
+            err_message = truncate_error(repr(error))
+            event_json = create_end_event_json(
+                error is None,
+                runtime,
+                table1.database.name,
+                table2.database.name,
+                table1_count,
+                table2_count,
+                diff_count,
+                err_message,
+            )
+            send_event_json(event_json)
+
     def _validate_and_adjust_columns(self, table1: TableSegment, table2: TableSegment) -> DiffResult:
         pass
 
@@ -270,6 +377,9 @@ class TableDiffer(ThreadBase, ABC):
     ):
         ...
 
+    def _new_yielder(self) -> ThreadedYielder:
+        return ThreadedYielder(self.max_threadpool_size, self.max_buffered_rows)
+
     def _bisect_and_diff_tables(self, table1: TableSegment, table2: TableSegment, info_tree):
         if len(table1.key_columns) != len(table2.key_columns):
             raise ValueError("Tables should have an equivalent number of key columns!")
@@ -288,6 +398,12 @@ class TableDiffer(ThreadBase, ABC):
         # Query min/max values
         key_ranges = self._threaded_call_as_completed("query_key_range", [table1, table2])
 
+        if self.shard_count:
+            return self._bisect_and_diff_shard(table1, table2, info_tree, key_types1, key_ranges)
+
+        if self._use_lexicographic_segments(table1, table2):
+            return self._bisect_and_diff_lexicographic(table1, table2, info_tree, key_types1, key_ranges)
+
         # Start with the first completed value, so we don't waste time waiting
         min_key1, max_key1 = self._parse_key_range_result(key_types1, next(key_ranges))
 
@@ -298,9 +414,11 @@ class TableDiffer(ThreadBase, ABC):
             f"size: table1 <= {btable1.approximate_size()}, table2 <= {btable2.approximate_size()}"
         )
 
-        ti = ThreadedYielder(self.max_threadpool_size)
+        ti = self._new_yielder()
         # Bisect (split) the table into segments, and diff them recursively.
-        ti.submit(self._bisect_and_diff_segments, ti, btable1, btable2, info_tree)
+        # The box gets a node of its own, next to the regions of the second pass, so the root only sums them up.
+        info_node = info_tree.add_node(btable1, btable2)
+        ti.submit(self._bisect_and_diff_segments, ti, btable1, btable2, info_node)
 
         # Now we check for the second min-max, to diff the portions we "missed".
         # This is achieved by subtracting the table ranges, and dividing the resulting space into aligned boxes.
@@ -322,12 +440,90 @@ class TableDiffer(ThreadBase, ABC):
 
         new_regions = [(p1, p2) for p1, p2 in box_mesh if p1 < p2 and not (p1 >= min_key1 and p2 <= max_key1)]
 
-        for p1, p2 in new_regions:
+        # Merge adjacent regions, so there are fewer of them to probe and bisect. (e.g. B1+B2+B3, B6+B7+B8 above)
+        for p1, p2 in merge_adjacent_boxes(new_regions):
             extra_tables = [t.new_key_bounds(min_key=p1, max_key=p2) for t in (table1, table2)]
-            ti.submit(self._bisect_and_diff_segments, ti, *extra_tables, info_tree)
+            ti.submit(self._probe_and_bisect_region, ti, *extra_tables, info_tree)
+
+        return ti
+
+    def _probe_and_bisect_region(self, ti: ThreadedYielder, table1: TableSegment, table2: TableSegment, info_tree):
+        # Regions of the second pass are often empty, so we count their rows before bisecting them
+        count1, count2 = self._threaded_call("count", [table1, table2])
+        if count1 == 0 and count2 == 0:
+            return
+
+        max_rows = max(count1, count2)
+        info_node = info_tree.add_node(table1, table2, max_rows=max_rows)
+        return self._bisect_and_diff_segments(ti, table1, table2, info_node, max_rows=max_rows)
+
+    def _use_lexicographic_segments(self, table1: TableSegment, table2: TableSegment) -> bool:
+        return False
+
+    def _bisect_and_diff_lexicographic(
+        self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree, key_types, key_ranges
+    ):
+        # Lexicographic intervals don't subtract into aligned regions like boxes do, so instead of a second pass,
+        # we wait for both key ranges, and start from a box that bounds both tables.
+        min_key, max_key = self._parse_bounding_key_range(key_types, key_ranges)
+
+        btable1, btable2 = [
+            t.new_key_bounds(min_key=min_key, max_key=max_key).with_lexicographic_bounds() for t in (table1, table2)
+        ]
+
+        logger.info(
+            f"Diffing segments at key-range: {btable1.min_key}..{btable2.max_key}, in lexicographic order. "
+            f"size: <= {btable1.approximate_size()}"
+        )
+
+        ti = self._new_yielder()
+        ti.submit(self._bisect_and_diff_segments, ti, btable1, btable2, info_tree)
+        return ti
+
+    def _bisect_and_diff_shard(
+        self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree, key_types, key_ranges
+    ):
+        # All the shards must split the same key space, so instead of a second pass, we wait for both key ranges,
+        # and split a box that bounds both tables along its first key column.
+        min_key, max_key = self._parse_bounding_key_range(key_types, key_ranges)
+        shard_bounds = self._get_shard_bounds(min_key[0], max_key[0])
+        if shard_bounds is None:
+            # The key space is too small to reach this shard
+            return self._new_yielder()
+
+        min_key = Vector((shard_bounds[0], *min_key[1:]))
+        max_key = Vector((shard_bounds[1], *max_key[1:]))
+        btable1, btable2 = [t.new_key_bounds(min_key=min_key, max_key=max_key) for t in (table1, table2)]
+        if self._use_lexicographic_segments(table1, table2):
+            btable1, btable2 = [t.with_lexicographic_bounds() for t in (btable1, btable2)]
+
+        logger.info(
+            f"Diffing shard {self.shard_index + 1}/{self.shard_count}, "
+            f"at key-range: {btable1.min_key}..{btable2.max_key}. size: <= {btable1.approximate_size()}"
+        )
 
+        ti = self._new_yielder()
+        ti.submit(self._bisect_and_diff_segments, ti, btable1, btable2, info_tree)
         return ti
 
+    def _get_shard_bounds(self, min_key: DbKey, max_key: DbKey) -> Optional[Tuple[DbKey, DbKey]]:
+        "Returns the range of the first key column that belongs to this shard, or None if it's empty"
+        if max_key - min_key > self.shard_count:
+            points = split_key_space(min_key, max_key, self.shard_count - 1)
+        else:
+            points = [min_key, max_key]
+
+        if self.shard_index >= len(points) - 1:
+            return None
+        return points[self.shard_index], points[self.shard_index + 1]
+
+    def _parse_bounding_key_range(self, key_types, key_ranges) -> Tuple[Vector, Vector]:
+        "Returns the bounds of a box that contains the key ranges of both tables"
+        (min_key1, max_key1), (min_key2, max_key2) = [self._parse_key_range_result(key_types, r) for r in key_ranges]
+        min_key = Vector(min(a, b) for a, b in safezip(min_key1, min_key2))
+        max_key = Vector(max(a, b) for a, b in safezip(max_key1, max_key2))
+        return min_key, max_key
+
     def _parse_key_range_result(self, key_types, key_range) -> Tuple[Vector, Vector]:
         min_key_values, max_key_values = key_range
 
@@ -340,6 +536,28 @@ class TableDiffer(ThreadBase, ABC):
 
         return min_key, max_key
 
+    def _choose_checkpoints(
+        self, table1: TableSegment, table2: TableSegment, max_rows: int = None, level: int = 0
+    ) -> List[List[DbKey]]:
+        # Choose evenly spaced checkpoints (according to min_key and max_key)
+        biggest_table = max(table1, table2, key=methodcaller("approximate_size"))
+        return biggest_table.choose_checkpoints(self.bisection_factor - 1)
+
+    def _choose_lexicographic_checkpoints(
+        self, table1: TableSegment, table2: TableSegment, max_rows: int = None, level: int = 0
+    ) -> List[Vector]:
+        # Both tables share the same key space, and the same lexicographic bounds
+        return table1.choose_lexicographic_checkpoints(self.bisection_factor - 1)
+
+    def _segment_priority(self, level: int, parent: InfoTree) -> int:
+        "Priority of the new segments of a bisection at `level`, whose parent segment is `parent`"
+        if self.scheduling == Scheduling.BREADTH_FIRST:
+            return -level
+        if self.scheduling == Scheduling.MOST_SUSPICIOUS_FIRST:
+            rowcounts = parent.info.rowcounts
+            return abs(rowcounts.get(1, 0) - rowcounts.get(2, 0))
+        return level
+
     def _bisect_and_diff_segments(
         self,
         ti: ThreadedYielder,
@@ -351,17 +569,29 @@ class TableDiffer(ThreadBase, ABC):
     ):
         assert table1.is_bounded and table2.is_bounded
 
-        # Choose evenly spaced checkpoints (according to min_key and max_key)
-        biggest_table = max(table1, table2, key=methodcaller("approximate_size"))
-        checkpoints = biggest_table.choose_checkpoints(self.bisection_factor - 1)
-
         # Create new instances of TableSegment between each checkpoint
-        segmented1 = table1.segment_by_checkpoints(checkpoints)
-        segmented2 = table2.segment_by_checkpoints(checkpoints)
+        if table1.is_lexicographic:
+            checkpoints = self._choose_lexicographic_checkpoints(table1, table2, max_rows, level)
+            segmented1 = table1.segment_by_lexicographic_checkpoints(checkpoints)
+            segmented2 = table2.segment_by_lexicographic_checkpoints(checkpoints)
+        else:
+            checkpoints = self._choose_checkpoints(table1, table2, max_rows, level)
+            segmented1 = table1.segment_by_checkpoints(checkpoints)
+            segmented2 = table2.segment_by_checkpoints(checkpoints)
 
         # Recursively compare each pair of corresponding segments between table1 and table2
+        priority = self._segment_priority(level, info_tree)
         for i, (t1, t2) in enumerate(safezip(segmented1, segmented2)):
             info_node = info_tree.add_node(t1, t2, max_rows=max_rows)
             ti.submit(
-                self._diff_segments, ti, t1, t2, info_node, max_rows, level + 1, i + 1, len(segmented1), priority=level
+                self._diff_segments,
+                ti,
+                t1,
+                t2,
+                info_node,
+                max_rows,
+                level + 1,
+                i + 1,
+                len(segmented1),
+                priority=priority,
             )
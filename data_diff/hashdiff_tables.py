@@ -1,25 +1,41 @@
 import os
+import time
+import math
+import threading
+import multiprocessing
 from numbers import Number
 import logging
-from collections import defaultdict
-from typing import Iterator
-from operator import attrgetter
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from itertools import groupby
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from functools import partial
+from operator import attrgetter, methodcaller
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from runtype import dataclass
 
 from sqeleton.abcs import ColType_UUID, NumericType, PrecisionType, StringType, Boolean
+from sqeleton.databases.base import ThreadedDatabase
 
 from .info_tree import InfoTree
-from .utils import safezip
+from .utils import safezip, Vector
 from .thread_utils import ThreadedYielder
 from .table_segment import TableSegment
+from .checksum_cache import ChecksumCache
+from .journal import DiffJournal
+from .arrow_utils import import_pyarrow, supports_arrow, arrow_exclusive_rows
 
-from .diff_tables import TableDiffer
+from .diff_tables import TableDiffer, Scheduling, DiffResult
 
 BENCHMARK = os.environ.get("BENCHMARK", False)
 
 DEFAULT_BISECTION_THRESHOLD = 1024 * 16
 DEFAULT_BISECTION_FACTOR = 32
+DEFAULT_CHECKPOINT_SAMPLE_SIZE = 1024
+DEFAULT_MAX_CONCURRENCY = 16
+# Below this many rows, sending them to another process costs more than comparing them
+MIN_ROWS_FOR_COMPARISON_PROCESS = 10000
 
 logger = logging.getLogger("hashdiff_tables")
 
@@ -42,6 +58,345 @@ def diff_sets(a: set, b: set) -> Iterator:
         yield from v
 
 
+def _database_thread_count(db) -> Optional[int]:
+    "Returns the number of threads that run the queries of the database, or None if it doesn't run them on a pool"
+    if isinstance(db, ThreadedDatabase):
+        return db._queue._max_workers
+    return None
+
+
+def _diff_sets_list(a: list, b: list) -> list:
+    # Runs in a worker process of HashDiffer.comparison_processes
+    return list(diff_sets(a, b))
+
+
+_FIELD_SEP = "\x1f"
+_ROW_SEP = "\x1e"
+_NULL = "\x1d"
+
+
+def _encode_rows(rows: list) -> Optional[str]:
+    """Joins rows of strings into a single string, that is much cheaper to send to a worker process than the rows.
+
+    Returns None when the rows can't be split back from it, i.e. when a value contains one of the separators.
+    """
+    if not rows:
+        return None
+
+    try:
+        buf = _ROW_SEP.join(map(_FIELD_SEP.join, rows))
+        null_count = 0
+    except TypeError:
+        # Some values are NULL
+        try:
+            buf = _ROW_SEP.join(_FIELD_SEP.join(_NULL if v is None else v for v in row) for row in rows)
+        except TypeError:
+            return None
+        null_count = sum(row.count(None) for row in rows)
+
+    width = len(rows[0])
+    if (
+        buf.count(_ROW_SEP) != len(rows) - 1
+        or buf.count(_FIELD_SEP) != len(rows) * (width - 1)
+        or buf.count(_NULL) != null_count
+    ):
+        return None
+    return buf
+
+
+def _decode_row(s: str) -> tuple:
+    return tuple(None if v == _NULL else v for v in s.split(_FIELD_SEP))
+
+
+def _diff_encoded_rows(buf1: str, buf2: str) -> list:
+    # Runs in a worker process of HashDiffer.comparison_processes. Like _diff_sets_list(), for rows from _encode_rows()
+    rows1 = buf1.split(_ROW_SEP)
+    rows2 = buf2.split(_ROW_SEP)
+    set1 = set(rows1)
+    set2 = set(rows2)
+    # Only the exclusive rows are split back into values, to be ordered like diff_sets() does
+    exclusive1 = [_decode_row(r) for r in rows1 if r not in set2]
+    exclusive2 = [_decode_row(r) for r in rows2 if r not in set1]
+    return list(diff_sets(exclusive1, exclusive2))
+
+
+class BisectionTuner:
+    """Chooses the bisection factor, and whether to download or bisect, for each segment at runtime.
+
+    It keeps running averages of the checksum latency, and of the download time per row,
+    as well as the share of segments that turned out to be different at each level (diff density).
+
+    A segment is downloaded when the estimated time to download it is lower than the time it would take to bisect
+    it first, i.e. another round of checksums, followed by a download of only its differing parts.
+    The bisection factor is chosen so that the new segments are about the size that can be downloaded
+    in the time of a single checksum. Until there are enough measurements, the configured values are used.
+
+    The instance is thread-safe, and may be reused across diffs of the same tables, to start with warm estimates.
+
+    Parameters:
+        min_factor (int): Lowest bisection factor to choose.
+        max_factor (int): Highest bisection factor to choose.
+        max_download_rows (int): Never download segments bigger than this, regardless of the estimates.
+        smoothing (float): Weight of each new measurement in the running averages (0..1).
+    """
+
+    def __init__(
+        self,
+        min_factor: int = 2,
+        max_factor: int = DEFAULT_BISECTION_FACTOR * 8,
+        max_download_rows: int = DEFAULT_BISECTION_THRESHOLD * 64,
+        smoothing: float = 0.3,
+    ):
+        if not (2 <= min_factor <= max_factor):
+            raise ValueError("Incorrect param values (must have 2 <= min_factor <= max_factor)")
+
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.max_download_rows = max_download_rows
+        self.smoothing = smoothing
+
+        self._lock = threading.Lock()
+        self._checksum_latency = {}  # level -> seconds per checksum query
+        self._download_time_per_row = None
+        self._segments_per_level = defaultdict(lambda: [0, 0])  # level -> [count, different]
+
+    def _average(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return current + self.smoothing * (value - current)
+
+    def record_checksum(self, level: int, duration: float):
+        with self._lock:
+            self._checksum_latency[level] = self._average(self._checksum_latency.get(level), duration)
+
+    def record_segment(self, level: int, is_diff: bool):
+        with self._lock:
+            counts = self._segments_per_level[level]
+            counts[0] += 1
+            counts[1] += bool(is_diff)
+
+    def record_download(self, rows: int, duration: float):
+        if rows:
+            with self._lock:
+                self._download_time_per_row = self._average(self._download_time_per_row, duration / rows)
+
+    def _latency_at(self, level: int) -> Optional[float]:
+        # Segments get smaller as we go deeper, so the closest level above is a pessimistic estimate
+        known = [l for l in self._checksum_latency if l <= level]
+        if known:
+            return self._checksum_latency[max(known)]
+        return min(self._checksum_latency.values(), default=None)
+
+    def _diff_density_at(self, level: int, factor: int) -> float:
+        count, different = self._segments_per_level.get(level, (0, 0))
+        if count >= factor:
+            return different / count
+        count, different = map(sum, zip(*self._segments_per_level.values())) if self._segments_per_level else (0, 0)
+        if count:
+            return different / count
+        # Nothing measured yet. Assume a single difference, which lands in one of the new segments.
+        return 1 / factor
+
+    def should_download(self, max_rows: int, level: int, threshold: Number, factor: int) -> bool:
+        "Decide whether to download a segment of up to `max_rows` rows at `level`, or to bisect it."
+        with self._lock:
+            latency = self._latency_at(level + 1)
+            time_per_row = self._download_time_per_row
+            if latency is None or time_per_row is None:
+                return max_rows < threshold
+
+            density = self._diff_density_at(level + 1, factor)
+
+        if max_rows > self.max_download_rows:
+            return False
+
+        download_time = max_rows * time_per_row
+        bisect_time = latency + density * download_time
+        return download_time <= bisect_time
+
+    def choose_factor(self, max_rows: int, level: int, default_factor: int) -> int:
+        "Choose how many segments to split a segment of up to `max_rows` rows into."
+        with self._lock:
+            latency = self._latency_at(level + 1)
+            time_per_row = self._download_time_per_row
+        if latency is None or not time_per_row:
+            return default_factor
+
+        # How many rows can be downloaded in the time it takes to run a checksum
+        target_rows = max(latency / time_per_row, 1)
+        factor = math.ceil(max_rows / target_rows)
+        return max(self.min_factor, min(factor, self.max_factor))
+
+
+class _ConcurrencyWindow:
+    "The measurements of the checksum queries of one bisection level, to one database"
+
+    def __init__(self):
+        self.best_latency = None
+        self.last_throughput = None
+        self.start()
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.queries = 0
+        self.rows = 0
+        self.latency = 0.0
+
+
+class _ConcurrencyState:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.windows = defaultdict(_ConcurrencyWindow)  # level -> _ConcurrencyWindow
+
+
+class ConcurrencyController:
+    """Limits the number of checksum queries in flight to each database, and adapts the limit at runtime (AIMD).
+
+    The queries are measured in windows of `window` queries. The limit grows by one (additive increase)
+    after each window whose throughput, in rows checksummed per second, improved over the previous one.
+    It's multiplied by `backoff` (multiplicative decrease) when a query fails, or when the average latency
+    of a window rises above `latency_tolerance` times the lowest average seen so far.
+
+    Segments shrink at each level of the bisection, and so do the rows and the latency of their checksums.
+    So each level is measured in windows of its own, and only compared with itself, so that going deeper
+    isn't mistaken for congestion.
+
+    The instance is thread-safe, and keeps a separate limit for each database.
+
+    Parameters:
+        max_limit (int): Highest number of queries in flight per database.
+        initial_limit (int): Number of queries in flight per database to start with.
+        window (int): Number of queries per measurement.
+        latency_tolerance (float): How much the latency may rise over its lowest average before backing off.
+        backoff (float): Factor to multiply the limit by when backing off (0..1).
+    """
+
+    def __init__(
+        self,
+        max_limit: int = DEFAULT_MAX_CONCURRENCY,
+        initial_limit: int = 1,
+        window: int = 8,
+        latency_tolerance: float = 2.0,
+        backoff: float = 0.5,
+    ):
+        if not (1 <= initial_limit <= max_limit):
+            raise ValueError("Incorrect param values (must have 1 <= initial_limit <= max_limit)")
+        if not (0 < backoff < 1):
+            raise ValueError("Incorrect param values (must have 0 < backoff < 1)")
+
+        self.max_limit = max_limit
+        self.initial_limit = initial_limit
+        self.window = window
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+
+        self._cond = threading.Condition()
+        self._states = {}  # database -> _ConcurrencyState
+
+    def _state(self, key) -> _ConcurrencyState:
+        if key not in self._states:
+            self._states[key] = _ConcurrencyState(self.initial_limit)
+        return self._states[key]
+
+    def get_limit(self, key) -> int:
+        with self._cond:
+            return self._state(key).limit
+
+    def acquire(self, key):
+        "Waits until there's room for another query to the database `key`"
+        with self._cond:
+            state = self._state(key)
+            while state.in_flight >= state.limit:
+                self._cond.wait()
+            state.in_flight += 1
+
+    def release(self, key, duration: float, rows: int = 0, failed: bool = False, level: int = 0):
+        "Records a query to the database `key`, for a segment at the given bisection level, and adapts its limit"
+        with self._cond:
+            state = self._state(key)
+            state.in_flight -= 1
+
+            if failed:
+                self._decrease(key, state, "a query failed")
+            else:
+                window = state.windows[level]
+                window.queries += 1
+                window.rows += rows
+                window.latency += duration
+                if window.queries >= self.window:
+                    self._end_window(key, state, window)
+
+            self._cond.notify_all()
+
+    def _end_window(self, key, state: _ConcurrencyState, window: _ConcurrencyWindow):
+        throughput = window.rows / max(time.monotonic() - window.start_time, 1e-9)
+        latency = window.latency / window.queries
+
+        best_latency = window.best_latency
+        if state.limit > 1 and best_latency is not None and latency > best_latency * self.latency_tolerance:
+            self._decrease(key, state, f"latency rose to {latency:.3f}s")
+            return
+
+        if window.best_latency is None or state.limit == 1:
+            # Without concurrency, the latency is the baseline to compare with
+            window.best_latency = latency
+        else:
+            window.best_latency = min(window.best_latency, latency)
+        if window.last_throughput is None or throughput > window.last_throughput:
+            if state.limit < self.max_limit:
+                state.limit += 1
+                logger.debug(f"Raised the concurrency limit of {key} to {state.limit} ({throughput:.0f} rows/s)")
+        window.last_throughput = throughput
+        window.start()
+
+    def _decrease(self, key, state: _ConcurrencyState, reason: str):
+        state.limit = max(1, int(state.limit * self.backoff))
+        # Measure again from scratch, at the new limit
+        for window in state.windows.values():
+            window.last_throughput = None
+            window.start()
+        logger.debug(f"Lowered the concurrency limit of {key} to {state.limit}, because {reason}")
+
+
+def diff_sorted(rows1: Iterable[tuple], rows2: Iterable[tuple], key: Callable[[tuple], tuple]) -> Iterator:
+    """Like diff_sets(), but for rows that are already sorted by key.
+
+    Merge-joins the two streams of rows, yielding the differences as it goes, without loading them into memory.
+    Only rows that share the same key are compared as sets, which keeps duplicate keys working like in diff_sets().
+
+    Parameters:
+        key: Returns the key of the given row. The order of the keys must agree with the order of the rows.
+    """
+
+    def _groups(rows):
+        last_key = None
+        for k, group in groupby(rows, key):
+            if last_key is not None and not (last_key < k):
+                raise ValueError(f"Rows are not sorted by key ({last_key} came before {k})")
+            last_key = k
+            yield k, group
+
+    groups1 = _groups(rows1)
+    groups2 = _groups(rows2)
+    g1 = next(groups1, None)
+    g2 = next(groups2, None)
+
+    while g1 is not None or g2 is not None:
+        if g2 is None or (g1 is not None and g1[0] < g2[0]):
+            for row in g1[1]:
+                yield "-", row
+            g1 = next(groups1, None)
+        elif g1 is None or g2[0] < g1[0]:
+            for row in g2[1]:
+                yield "+", row
+            g2 = next(groups2, None)
+        else:
+            yield from diff_sets(list(g1[1]), list(g2[1]))
+            g1 = next(groups1, None)
+            g2 = next(groups2, None)
+
+
 @dataclass
 class HashDiffer(TableDiffer):
     """Finds the diff between two SQL tables
@@ -54,23 +409,231 @@ class HashDiffer(TableDiffer):
     Parameters:
         bisection_factor (int): Into how many segments to bisect per iteration.
         bisection_threshold (Number): When should we stop bisecting and compare locally (in row count).
+        download_byte_budget (int, optional): When provided, segments are downloaded once their estimated size in
+                                              bytes is below it, instead of once their row count is below
+                                              `bisection_threshold`. The row size is estimated from the column
+                                              types, and then from the sizes of the rows downloaded so far.
+        bucketed_checksums (bool): Checksum all the segments of a bisection step in a single GROUP BY query
+                                   per table, instead of a query per segment.
+        quantile_checkpoints (bool): Place the bisection checkpoints at the quantiles of a random sample of the keys,
+                                     instead of spacing them evenly between min_key and max_key.
+                                     Recommended when the keys are skewed or have big gaps.
+        checkpoint_sample_size (int): How many keys to sample, when `quantile_checkpoints` is ``True``. The keys are
+                                      sampled once, at the top of the bisection, and the sample is reused to split
+                                      the smaller segments, for as long as enough of its keys fall in them.
+        bisection_tuner (BisectionTuner, optional): When provided, it chooses the bisection factor and
+                                                    threshold for each segment at runtime, according to the observed
+                                                    query latency, download speed and diff density.
+                                                    `bisection_factor` and `bisection_threshold` are then used as
+                                                    the initial values.
+        sorted_merge (bool): Download the segments ordered by key, and compare them with a streaming merge-join,
+                             instead of building sets in memory. The differences are yielded as they are found.
+                             Only applies to numeric keys, whose order is the same in every database.
+        fetch_batch_size (int, optional): When provided along with `sorted_merge`, the segments are streamed from a
+                                          database cursor, `fetch_batch_size` rows at a time, and compared while
+                                          they are being fetched. Memory use then no longer grows with the
+                                          bisection threshold. Each stream opens its own database connection.
+        lexicographic_segments (bool): For compound integer keys, split the key space in lexicographic order,
+                                       so that each segment is a single range scan on a composite index of the key.
+                                       Otherwise, segments are boxes in the key space, which an index can't seek.
+        hash_then_fetch (bool): Download a hash of each row (along with its key) instead of the whole row, and then
+                                download only the rows whose hashes differ. Cuts the transferred bytes for
+                                wide tables, at the cost of a second round-trip for segments with differences.
+        arrow_fetch (bool): Download the segments as Arrow tables, and match their rows with vectorized operations,
+                            so that only the differing rows are turned into Python objects.
+                            Only applies to databases whose driver supports Arrow (DuckDB, Snowflake, BigQuery).
+                            Requires pyarrow.
+        checksum_cache (ChecksumCache, optional): When provided, segment checksums are stored in it, and reused by
+                                                  later diffs of the same tables, as long as the segment's
+                                                  row count and max(update_column) haven't changed.
+                                                  Only applies to tables with an `update_column`.
+        journal (DiffJournal, optional): When provided, completed segments are recorded in it, with their row counts
+                                         and differences. Segments that are already in it aren't diffed again, and
+                                         their differences are replayed from it instead. Lets an interrupted diff
+                                         resume where it stopped.
+        threads1 (int, optional): Maximum number of concurrent queries to the database of table1. Usually the size
+                                  of its connection pool. When either `threads1` or `threads2` is provided, the
+                                  queries to each database are dispatched to a pool of their own, so that a slow
+                                  database doesn't take up the threads that the other one could use.
+                                  The pools last for the diff, and are capped by the thread count of the database.
+                                  Defaults to the thread count of the database, or else `max_threadpool_size`.
+        threads2 (int, optional): Maximum number of concurrent queries to the database of table2.
+                                  Defaults like `threads1`.
+        concurrency_controller (ConcurrencyController, optional): When provided, it limits the number of checksum
+                                                                  queries in flight to each database, raising the
+                                                                  limit while the throughput improves, and backing
+                                                                  off when the latency rises or queries fail.
+                                                                  Doesn't apply to `bucketed_checksums`.
+        scheduling (Scheduling): In which order to diff the segments. `DEPTH_FIRST` finds the first differences
+                                 soonest, and keeps the fewest segments in memory. `BREADTH_FIRST` has the most
+                                 segments ready to run in parallel. `MOST_SUSPICIOUS_FIRST` starts with the segments
+                                 whose parent had the biggest difference in row count. (default: DEPTH_FIRST)
+        comparison_processes (int, optional): When provided, downloaded segments of at least
+                                              `MIN_ROWS_FOR_COMPARISON_PROCESS` rows are compared in a pool of
+                                              this many worker processes, instead of in the query threads.
+                                              Lets the comparison use more cores, without holding the GIL
+                                              that the query threads need.
+        shard_count (int, optional): When provided, the key space is split along its first column into this many
+                                     shards, and only the shard `shard_index` (0-based) is diffed. Running all the
+                                     shards, e.g. on different processes or machines, covers the whole diff.
+                                     Their stats can be combined with :func:`merge_shard_stats`.
+        shard_index (int, optional): Which shard to diff, when `shard_count` is provided.
         threaded (bool): Enable/disable threaded diffing. Needed to take advantage of database threads.
         max_threadpool_size (int): Maximum size of each threadpool. ``None`` means auto.
                                    Only relevant when `threaded` is ``True``.
                                    There may be many pools, so number of actual threads can be a lot higher.
+        max_buffered_rows (int, optional): Maximum number of diff rows to buffer for the consumer. When reached,
+                                           the diffing threads wait until the consumer catches up. ``None`` means
+                                           unbounded.
     """
 
     bisection_factor: int = DEFAULT_BISECTION_FACTOR
     bisection_threshold: Number = DEFAULT_BISECTION_THRESHOLD  # Accepts inf for tests
+    download_byte_budget: int = None
+    bucketed_checksums: bool = False
+    quantile_checkpoints: bool = False
+    checkpoint_sample_size: int = DEFAULT_CHECKPOINT_SAMPLE_SIZE
+    bisection_tuner: BisectionTuner = None
+    sorted_merge: bool = False
+    fetch_batch_size: int = None
+    lexicographic_segments: bool = False
+    hash_then_fetch: bool = False
+    arrow_fetch: bool = False
+    checksum_cache: ChecksumCache = None
+    journal: DiffJournal = None
+    threads1: int = None
+    threads2: int = None
+    concurrency_controller: ConcurrencyController = None
+    scheduling: Scheduling = Scheduling.DEPTH_FIRST
+    comparison_processes: int = None
+    shard_count: int = None
+    shard_index: int = None
 
     stats: dict = {}
 
+    _database_pools = None
+    _comparison_pool = None
+
     def __post_init__(self):
+        super().__post_init__()
+        object.__setattr__(self, "_database_pools", {})  # (database1, database2) -> [pools, number of diffs]
+
         # Validate options
         if self.bisection_factor >= self.bisection_threshold:
             raise ValueError("Incorrect param values (bisection factor must be lower than threshold)")
         if self.bisection_factor < 2:
             raise ValueError("Must have at least two segments per iteration (i.e. bisection_factor >= 2)")
+        if self.arrow_fetch:
+            # Fail early, rather than at the first download
+            import_pyarrow()
+        if (self.shard_count is None) != (self.shard_index is None):
+            raise ValueError("shard_count and shard_index must be provided together")
+        if self.shard_count is not None and not (0 <= self.shard_index < self.shard_count):
+            raise ValueError("Incorrect param values (must have 0 <= shard_index < shard_count)")
+
+    def _get_comparison_pool(self) -> ProcessPoolExecutor:
+        "Returns the pool of comparison_processes. It's created on first use, and reused after."
+        if self._comparison_pool is None:
+            with self._task_pool_lock:
+                if self._comparison_pool is None:
+                    # Forking a process that runs threads can deadlock, so the workers start from scratch
+                    mp_context = multiprocessing.get_context("spawn")
+                    pool = ProcessPoolExecutor(self.comparison_processes, mp_context=mp_context)
+                    object.__setattr__(self, "_comparison_pool", pool)
+        return self._comparison_pool
+
+    def close(self):
+        super().close()
+        with self._task_pool_lock:
+            comparison_pool = self._comparison_pool
+            object.__setattr__(self, "_comparison_pool", None)
+        if comparison_pool is not None:
+            comparison_pool.shutdown()
+
+    def _database_pool_size(self, db, threads: Optional[int]) -> int:
+        # sqeleton runs the queries of a threaded database on a pool of its own. More threads than that
+        # would only wait in its queue.
+        sizes = [n for n in (threads, _database_thread_count(db)) if n]
+        return min(sizes) if sizes else self.max_threadpool_size
+
+    @contextmanager
+    def _database_pools_for(self, table1: TableSegment, table2: TableSegment):
+        "Dispatches the calls of each side to a pool of its own, for as long as the block runs"
+        key = (table1.database, table2.database)
+        with self._task_pool_lock:
+            if key not in self._database_pools:
+                pools = [
+                    ThreadPoolExecutor(self._database_pool_size(t.database, n))
+                    for t, n in safezip([table1, table2], [self.threads1, self.threads2])
+                ]
+                self._database_pools[key] = [pools, 0]
+            # Diffs of the same databases that run at the same time share their pools, so that `threads1`
+            # and `threads2` bound the queries to each database. The last one to end shuts them down.
+            self._database_pools[key][1] += 1
+        try:
+            yield
+        finally:
+            with self._task_pool_lock:
+                entry = self._database_pools[key]
+                entry[1] -= 1
+                pools = None
+                if not entry[1]:
+                    pools = entry[0]
+                    del self._database_pools[key]
+            for pool in pools or ():
+                pool.shutdown(wait=False)
+
+    def _database_pools_of(self, items: list) -> Optional[List[ThreadPoolExecutor]]:
+        """Returns the pools of the databases that the items are the sides of, or None if they have none.
+
+        The items are the two sides of a diff, as passed to _thread_map(): each a table, or a (side, table) tuple.
+        """
+        if not self._database_pools or len(items) != 2:
+            return None
+
+        tables = [item[1] if isinstance(item, tuple) else item for item in items]
+        if not all(isinstance(t, TableSegment) for t in tables):
+            return None
+
+        with self._task_pool_lock:
+            entry = self._database_pools.get((tables[0].database, tables[1].database))
+        return entry and entry[0]
+
+    @contextmanager
+    def _diff_resources(self, table1: TableSegment, table2: TableSegment):
+        if not (self.threaded and (self.threads1 or self.threads2)):
+            yield
+            return
+
+        with self._database_pools_for(table1, table2):
+            yield
+
+    def _diff_tables_root(self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree) -> DiffResult:
+        if self.journal is not None:
+            self.journal.start(table1, table2)
+
+        return super()._diff_tables_root(table1, table2, info_tree)
+
+    def _thread_map(self, func, iterable):
+        items = list(iterable)
+        pools = self._database_pools_of(items)
+        if pools is None:
+            return super()._thread_map(func, items)
+
+        # Each side runs on the pool of its own database
+        futures = [pool.submit(func, item) for pool, item in safezip(pools, items)]
+        return [f.result() for f in futures]
+
+    def _thread_as_completed(self, func, iterable):
+        items = list(iterable)
+        pools = self._database_pools_of(items)
+        if pools is None:
+            yield from super()._thread_as_completed(func, items)
+            return
+
+        futures = [pool.submit(func, item) for pool, item in safezip(pools, items)]
+        for future in as_completed(futures):
+            yield future.result()
 
     def _validate_and_adjust_columns(self, table1, table2):
         for c1, c2 in safezip(table1.relevant_columns, table2.relevant_columns):
@@ -135,6 +698,7 @@ class HashDiffer(TableDiffer):
         level=0,
         segment_index=None,
         segment_count=None,
+        checksums=None,
     ):
         logger.info(
             ". " * level + f"Diffing segment {segment_index}/{segment_count}, "
@@ -142,6 +706,10 @@ class HashDiffer(TableDiffer):
             f"size <= {max_rows}"
         )
 
+        resumed = self._resume_segment(table1, table2, info_tree, level)
+        if resumed is not None:
+            return resumed
+
         # When benchmarking, we want the ability to skip checksumming. This
         # allows us to download all rows for comparison in performance. By
         # default, data-diff will checksum the section first (when it's below
@@ -150,29 +718,228 @@ class HashDiffer(TableDiffer):
             if max_rows < self.bisection_threshold:
                 return self._bisect_and_diff_segments(ti, table1, table2, info_tree, level=level, max_rows=max_rows)
 
-        (count1, checksum1), (count2, checksum2) = self._threaded_call("count_and_checksum", [table1, table2])
+        if checksums is None:
+            start = time.monotonic()
+            count_and_checksum = partial(self._count_and_checksum, level=level)
+            checksums = list(self._thread_map(count_and_checksum, enumerate([table1, table2], 1)))
+            if self.bisection_tuner:
+                self.bisection_tuner.record_checksum(level, time.monotonic() - start)
+        (count1, checksum1), (count2, checksum2) = checksums
 
         assert not info_tree.info.rowcounts
         info_tree.info.rowcounts = {1: count1, 2: count2}
 
+        if self.bisection_tuner:
+            self.bisection_tuner.record_segment(level, checksum1 != checksum2)
+
         if count1 == 0 and count2 == 0:
             logger.debug(
                 "Uneven distribution of keys detected in segment %s..%s (big gaps in the key column). "
-                "For better performance, we recommend to increase the bisection-threshold.",
+                "For better performance, we recommend to increase the bisection-threshold, "
+                "or to use quantile checkpoints.",
                 table1.min_key,
                 table1.max_key,
             )
             assert checksum1 is None and checksum2 is None
             info_tree.info.is_diff = False
+            self._record_segment(table1, table2, info_tree)
             return
 
         if checksum1 == checksum2:
             info_tree.info.is_diff = False
+            self._record_segment(table1, table2, info_tree)
             return
 
         info_tree.info.is_diff = True
+        if ti.is_cancelled:
+            # Don't start downloading or bisecting a segment whose results won't be consumed
+            return
+
+        if count1 == 0 or count2 == 0:
+            # All the rows are exclusive to one table, so there's nothing to bisect
+            sign = "-" if count1 else "+"
+            return self._diff_one_sided_segment(ti, table1, table2, sign, info_tree, level, max(count1, count2))
+
         return self._bisect_and_diff_segments(ti, table1, table2, info_tree, level=level, max_rows=max(count1, count2))
 
+    def _diff_one_sided_segment(
+        self,
+        ti: ThreadedYielder,
+        table1: TableSegment,
+        table2: TableSegment,
+        sign: str,
+        info_tree: InfoTree,
+        level: int,
+        row_count: int,
+    ):
+        table = table1 if sign == "-" else table2
+
+        # Download in pages of about bisection_threshold rows, to keep memory use bounded
+        pages = math.ceil(row_count / self._get_bisection_threshold(table, table))
+        if pages > 1 and table.approximate_size() > 1:
+            if table.is_lexicographic:
+                checkpoints = table.choose_lexicographic_checkpoints(pages - 1)
+                segmented1, segmented2 = [t.segment_by_lexicographic_checkpoints(checkpoints) for t in (table1, table2)]
+            else:
+                checkpoints = table.choose_checkpoints(pages - 1)
+                segmented1, segmented2 = [t.segment_by_checkpoints(checkpoints) for t in (table1, table2)]
+
+            if len(segmented1) > 1:
+                logger.info(
+                    ". " * level + f"Segment only has rows on one side ('{sign}'). "
+                    f"Downloading {row_count} rows in {len(segmented1)} pages."
+                )
+                priority = self._segment_priority(level, info_tree)
+                for t1, t2 in safezip(segmented1, segmented2):
+                    info_node = info_tree.add_node(t1, t2)
+                    ti.submit(self._diff_one_sided_page, ti, t1, t2, sign, info_node, level + 1, priority=priority)
+                return
+
+        rows = table.get_values()
+        self._measure_downloaded_rows(rows)
+        diff = list(diff_sets(rows, []) if sign == "-" else diff_sets([], rows))
+        info_tree.info.set_diff(diff)
+        self._record_segment(table1, table2, info_tree)
+
+        logger.info(". " * level + f"Segment only has rows on one side ('{sign}'). Diff found {len(diff)} different rows.")
+        self.stats["rows_downloaded"] = self.stats.get("rows_downloaded", 0) + len(rows)
+        return diff
+
+    def _diff_one_sided_page(
+        self, ti: ThreadedYielder, table1: TableSegment, table2: TableSegment, sign: str, info_tree: InfoTree, level: int
+    ):
+        resumed = self._resume_segment(table1, table2, info_tree, level)
+        if resumed is not None:
+            return resumed
+        if ti.is_cancelled:
+            return
+
+        # The pages are split evenly by key, so when the keys are skewed, some of them may hold many more rows than
+        # others. Each page is counted before it's downloaded, and split again if it's too big.
+        row_count = (table1 if sign == "-" else table2).count()
+        info_tree.info.rowcounts = {1: row_count, 2: 0} if sign == "-" else {1: 0, 2: row_count}
+        info_tree.info.is_diff = row_count > 0
+        if not row_count:
+            info_tree.info.diff_count = 0
+            self._record_segment(table1, table2, info_tree)
+            return
+
+        return self._diff_one_sided_segment(ti, table1, table2, sign, info_tree, level, row_count)
+
+    def _resume_segment(self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree, level: int):
+        "Returns the differences of the segment from the journal, or None if it wasn't completed"
+        if self.journal is None:
+            return None
+        journaled = self.journal.get(table1, table2)
+        if journaled is None:
+            return None
+
+        rowcounts, diff = journaled
+        info_tree.info.set_diff(diff)
+        info_tree.info.rowcounts = rowcounts
+
+        logger.info(". " * level + f"Segment was completed by a previous run. Replaying {len(diff)} different rows.")
+        self.stats["segments_resumed"] = self.stats.get("segments_resumed", 0) + 1
+        return diff
+
+    def _record_segment(self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree):
+        if self.journal is not None:
+            self.journal.put(table1, table2, info_tree.info.rowcounts, info_tree.info.diff or [])
+
+    def _count_and_checksum(
+        self, side_and_table: Tuple[int, TableSegment], level: int = 0
+    ) -> Tuple[int, Optional[int]]:
+        "Counts and checksums the segment of the given side (1 or 2) of the diff, at the given bisection level"
+        side, table = side_and_table
+        controller = self.concurrency_controller
+        if controller is None:
+            return self._cached_count_and_checksum(side, table)
+
+        controller.acquire(table.database)
+        start = time.monotonic()
+        try:
+            count, checksum = self._cached_count_and_checksum(side, table)
+        except Exception:
+            controller.release(table.database, time.monotonic() - start, failed=True, level=level)
+            raise
+        controller.release(table.database, time.monotonic() - start, rows=count, level=level)
+        return count, checksum
+
+    def _cached_count_and_checksum(self, side: int, table: TableSegment) -> Tuple[int, Optional[int]]:
+        if self.checksum_cache is None or not table.update_column:
+            return table.count_and_checksum()
+
+        # Probe the segment cheaply, and only checksum it if it changed since it was cached
+        probe = table.count_and_max_update()
+        cached = self.checksum_cache.get(table, side, probe)
+        if cached is not None:
+            self.stats["checksums_from_cache"] = self.stats.get("checksums_from_cache", 0) + 1
+            return cached
+
+        count, checksum = table.count_and_checksum()
+        self.checksum_cache.put(table, side, probe, count, checksum)
+        return count, checksum
+
+    def _get_bisection_factor(self, max_rows: int, level: int) -> int:
+        if self.bisection_tuner:
+            return self.bisection_tuner.choose_factor(max_rows, level, self.bisection_factor)
+        return self.bisection_factor
+
+    def _get_bisection_threshold(self, table1: TableSegment, table2: TableSegment) -> Number:
+        if not self.download_byte_budget:
+            return self.bisection_threshold
+
+        rows_measured = self.stats.get("rows_measured")
+        if rows_measured:
+            row_size = self.stats["bytes_downloaded"] / rows_measured
+        else:
+            row_size = max(table1.estimate_row_size(), table2.estimate_row_size())
+        return max(int(self.download_byte_budget / max(row_size, 1)), self.bisection_factor)
+
+    def _measure_downloaded_rows(self, rows: list):
+        # Refines the row size used by download_byte_budget
+        if self.download_byte_budget:
+            size = sum(len(str(v)) for row in rows for v in row if v is not None)
+            self.stats["bytes_downloaded"] = self.stats.get("bytes_downloaded", 0) + size
+            self.stats["rows_measured"] = self.stats.get("rows_measured", 0) + len(rows)
+
+    def _should_download(self, max_rows: int, max_space_size: int, level: int, threshold: Number) -> bool:
+        if max_space_size < self.bisection_factor * 2:
+            return True
+        if self.bisection_tuner:
+            return self.bisection_tuner.should_download(
+                max_rows, level, threshold, self._get_bisection_factor(max_rows, level)
+            )
+        return max_rows < threshold
+
+    def _choose_checkpoints(self, table1: TableSegment, table2: TableSegment, max_rows: int = None, level: int = 0):
+        if max_rows is None or not self.bisection_tuner:
+            count = self.bisection_factor - 1
+        else:
+            count = self._get_bisection_factor(max_rows, level) - 1
+
+        biggest_table = max(table1, table2, key=methodcaller("approximate_size"))
+        if self.quantile_checkpoints:
+            return biggest_table.choose_checkpoints_by_sampling(count)
+        return biggest_table.choose_checkpoints(count)
+
+    def _use_lexicographic_segments(self, table1: TableSegment, table2: TableSegment) -> bool:
+        if not self.lexicographic_segments or len(table1.key_columns) < 2:
+            return False
+
+        # Lexicographic arithmetic is only implemented for integers
+        key_types = [t._schema[k] for t in (table1, table2) for k in t.key_columns]
+        return all(kt.python_type is int for kt in key_types)
+
+    def _choose_lexicographic_checkpoints(
+        self, table1: TableSegment, table2: TableSegment, max_rows: int = None, level: int = 0
+    ) -> List[Vector]:
+        if max_rows is None or not self.bisection_tuner:
+            count = self.bisection_factor - 1
+        else:
+            count = self._get_bisection_factor(max_rows, level) - 1
+        return table1.choose_lexicographic_checkpoints(count)
+
     def _bisect_and_diff_segments(
         self,
         ti: ThreadedYielder,
@@ -192,15 +959,184 @@ class HashDiffer(TableDiffer):
 
         # If count is below the threshold, just download and compare the columns locally
         # This saves time, as bisection speed is limited by ping and query performance.
-        if max_rows < self.bisection_threshold or max_space_size < self.bisection_factor * 2:
+        threshold = self._get_bisection_threshold(table1, table2)
+        if self._should_download(max_rows, max_space_size, level, threshold):
+            resumed = self._resume_segment(table1, table2, info_tree, level)
+            if resumed is not None:
+                return resumed
+
+            if self.hash_then_fetch:
+                return self._diff_segments_by_row_hashes(table1, table2, info_tree, level)
+
+            if self.arrow_fetch and supports_arrow(table1.database) and supports_arrow(table2.database):
+                return self._diff_arrow_segments(table1, table2, info_tree, level)
+
+            if self.sorted_merge and self._can_merge_sorted(table1, table2):
+                return self._diff_sorted_segments(table1, table2, info_tree, level)
+
+            start = time.monotonic()
             rows1, rows2 = self._threaded_call("get_values", [table1, table2])
-            diff = list(diff_sets(rows1, rows2))
+            if self.bisection_tuner:
+                self.bisection_tuner.record_download(max(len(rows1), len(rows2)), time.monotonic() - start)
+            self._measure_downloaded_rows(rows1)
+            self._measure_downloaded_rows(rows2)
+            diff = self._compare_rows(rows1, rows2)
 
             info_tree.info.set_diff(diff)
             info_tree.info.rowcounts = {1: len(rows1), 2: len(rows2)}
+            self._record_segment(table1, table2, info_tree)
 
             logger.info(". " * level + f"Diff found {len(diff)} different rows.")
             self.stats["rows_downloaded"] = self.stats.get("rows_downloaded", 0) + max(len(rows1), len(rows2))
             return diff
 
+        if self.quantile_checkpoints and table1._key_sample is None and not table1.is_lexicographic:
+            # Sample the keys only once, at the top of the bisection. The segments inherit the sample, and split by it.
+            biggest_table = max(table1, table2, key=methodcaller("approximate_size"))
+            sample = biggest_table.with_key_sample(self.checkpoint_sample_size)._key_sample
+            table1, table2 = [t.new(_key_sample=sample) for t in (table1, table2)]
+
+        if self.bucketed_checksums and not table1.is_lexicographic:
+            return self._bisect_and_diff_bucketed_segments(ti, table1, table2, info_tree, level, max_rows)
+
         return super()._bisect_and_diff_segments(ti, table1, table2, info_tree, level, max_rows)
+
+    def _compare_rows(self, rows1: list, rows2: list) -> list:
+        if not self.comparison_processes or len(rows1) + len(rows2) < MIN_ROWS_FOR_COMPARISON_PROCESS:
+            return list(diff_sets(rows1, rows2))
+
+        # Pickling the rows would take longer than comparing them, so they're sent to the worker process as
+        # a single string each, and only the differences are sent back.
+        # Meanwhile, this thread waits without holding the GIL, so the query threads keep running.
+        pool = self._get_comparison_pool()
+        buf1, buf2 = _encode_rows(rows1), _encode_rows(rows2)
+        if buf1 is None or buf2 is None:
+            return pool.submit(_diff_sets_list, rows1, rows2).result()
+        return pool.submit(_diff_encoded_rows, buf1, buf2).result()
+
+    def _diff_segments_by_row_hashes(self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree, level: int):
+        hashes1, hashes2 = self._threaded_call("get_row_hashes", [table1, table2])
+
+        # Compare as multisets, so that duplicate keys are accounted for
+        counts1 = Counter(hashes1)
+        counts2 = Counter(hashes2)
+        mismatched_keys = sorted({key for key, _ in (counts1 - counts2) + (counts2 - counts1)})
+
+        if mismatched_keys:
+            rows1, rows2 = self._thread_map(methodcaller("get_values_by_keys", mismatched_keys), [table1, table2])
+            diff = list(diff_sets(rows1, rows2))
+            rows_downloaded = max(len(rows1), len(rows2))
+        else:
+            diff = []
+            rows_downloaded = 0
+
+        info_tree.info.set_diff(diff)
+        info_tree.info.rowcounts = {1: len(hashes1), 2: len(hashes2)}
+        self._record_segment(table1, table2, info_tree)
+
+        logger.info(". " * level + f"Diff found {len(diff)} different rows.")
+        self.stats["row_hashes_downloaded"] = self.stats.get("row_hashes_downloaded", 0) + max(
+            len(hashes1), len(hashes2)
+        )
+        self.stats["rows_downloaded"] = self.stats.get("rows_downloaded", 0) + rows_downloaded
+        return diff
+
+    def _diff_arrow_segments(self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree, level: int):
+        start = time.monotonic()
+        t1, t2 = self._threaded_call("get_values_arrow", [table1, table2])
+        if self.bisection_tuner:
+            self.bisection_tuner.record_download(max(t1.num_rows, t2.num_rows), time.monotonic() - start)
+        diff = list(diff_sets(*arrow_exclusive_rows(t1, t2)))
+
+        info_tree.info.set_diff(diff)
+        info_tree.info.rowcounts = {1: t1.num_rows, 2: t2.num_rows}
+        self._record_segment(table1, table2, info_tree)
+
+        logger.info(". " * level + f"Diff found {len(diff)} different rows.")
+        self.stats["rows_downloaded"] = self.stats.get("rows_downloaded", 0) + max(t1.num_rows, t2.num_rows)
+        return diff
+
+    def _can_merge_sorted(self, table1: TableSegment, table2: TableSegment) -> bool:
+        # Other key types (e.g. strings) may be ordered differently by each database, according to its collation
+        return all(isinstance(t._schema[k], NumericType) for t in (table1, table2) for k in t.key_columns)
+
+    def _diff_sorted_segments(self, table1: TableSegment, table2: TableSegment, info_tree: InfoTree, level: int):
+        start = time.monotonic()
+        if self.fetch_batch_size:
+            # Both cursors are consumed side by side, so the fetch overlaps with the comparison
+            rowcounts = {1: 0, 2: 0}
+
+            def _count_rows(rows, i):
+                for row in rows:
+                    rowcounts[i] += 1
+                    yield row
+
+            rows1, rows2 = (
+                _count_rows(t.iter_values(self.fetch_batch_size, order_by_key=True), i)
+                for i, t in enumerate([table1, table2], 1)
+            )
+        else:
+            rows1, rows2 = self._thread_map(methodcaller("get_values", order_by_key=True), [table1, table2])
+            rowcounts = {1: len(rows1), 2: len(rows2)}
+
+        key_types = [table1._schema[k] for k in table1.key_columns]
+
+        def key(row):
+            return tuple(kt.make_value(v) for kt, v in zip(key_types, row))
+
+        diff = []
+        for d in diff_sorted(rows1, rows2, key):
+            diff.append(d)
+            yield d
+
+        downloaded = max(rowcounts.values())
+        if self.bisection_tuner:
+            self.bisection_tuner.record_download(downloaded, time.monotonic() - start)
+
+        info_tree.info.set_diff(diff)
+        info_tree.info.rowcounts = rowcounts
+        self._record_segment(table1, table2, info_tree)
+
+        logger.info(". " * level + f"Diff found {len(diff)} different rows.")
+        self.stats["rows_downloaded"] = self.stats.get("rows_downloaded", 0) + downloaded
+
+    def _bisect_and_diff_bucketed_segments(
+        self,
+        ti: ThreadedYielder,
+        table1: TableSegment,
+        table2: TableSegment,
+        info_tree: InfoTree,
+        level: int,
+        max_rows: int,
+    ):
+        checkpoints = self._choose_checkpoints(table1, table2, max_rows, level)
+
+        segmented1 = table1.segment_by_checkpoints(checkpoints)
+        segmented2 = table2.segment_by_checkpoints(checkpoints)
+
+        # Scan each table once, to count and checksum all of its segments.
+        # Not limited by the concurrency_controller: it's a single query per table for the whole bisection step,
+        # whose latency isn't comparable with the per-segment checksums that the controller measures.
+        start = time.monotonic()
+        checksums1, checksums2 = self._thread_map(
+            methodcaller("count_and_checksum_by_checkpoints", checkpoints), [table1, table2]
+        )
+        if self.bisection_tuner:
+            self.bisection_tuner.record_checksum(level + 1, time.monotonic() - start)
+
+        priority = self._segment_priority(level, info_tree)
+        for i, (t1, t2, cs1, cs2) in enumerate(safezip(segmented1, segmented2, checksums1, checksums2)):
+            info_node = info_tree.add_node(t1, t2, max_rows=max_rows)
+            ti.submit(
+                self._diff_segments,
+                ti,
+                t1,
+                t2,
+                info_node,
+                max_rows,
+                level + 1,
+                i + 1,
+                len(segmented1),
+                checksums=(cs1, cs2),
+                priority=priority,
+            )
@@ -123,6 +123,9 @@ class JoinDiffer(TableDiffer):
         max_threadpool_size (int): Maximum size of each threadpool. ``None`` means auto.
                                    Only relevant when `threaded` is ``True``.
                                    There may be many pools, so number of actual threads can be a lot higher.
+        max_buffered_rows (int, optional): Maximum number of diff rows to buffer for the consumer. When reached,
+                                           the diffing threads wait until the consumer catches up. ``None`` means
+                                           unbounded.
         validate_unique_key (bool): Enable/disable validating that the key columns are unique. (default: True)
                                     If there are no UNIQUE constraints in the schema, it is done in a single query,
                                     and can't be threaded, so it's very slow on non-cloud dbs.
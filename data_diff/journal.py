@@ -0,0 +1,116 @@
+"""Provides a journal of completed segments, for resuming an interrupted diff
+"""
+
+import json
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from .table_segment import TableSegment
+from .checksum_cache import database_identity, segment_key
+
+
+class DiffJournal:
+    """Records the segments of a diff as they complete, with their row counts and differences, in a local SQLite file.
+
+    When a diff is interrupted (e.g. by a dropped connection), running it again with the same journal, and `resume`,
+    skips the segments that were completed, and replays their differences from the journal instead.
+
+    The journal records the connections and tables of its diff, with their key columns, columns, filters and update
+    range. Resuming refuses to start if any of them changed, since the recorded differences would no longer apply.
+    Within the same diff, a segment is only matched if its key bounds are the same as when it was recorded.
+    So resuming with different options, such as another bisection factor, only reuses the segments that they share.
+
+    Parameters:
+        path (str): Path of the SQLite file. Created if it doesn't exist.
+        resume (bool): Whether to keep the segments that are already in the journal, to be skipped.
+                       If False, the journal is cleared, for a new diff. (default: False)
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.resume = resume
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS journal_header (header TEXT NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completed_segments "
+                "(segment TEXT PRIMARY KEY, count1 INTEGER NOT NULL, count2 INTEGER NOT NULL, diff TEXT NOT NULL)"
+            )
+            if not resume:
+                self._conn.execute("DELETE FROM journal_header")
+                self._conn.execute("DELETE FROM completed_segments")
+
+    @staticmethod
+    def _table_header(table: TableSegment) -> dict:
+        return {
+            "database": table.database.name,
+            "connection": database_identity(table.database),
+            "table_path": table.table_path,
+            "key_columns": table.key_columns,
+            "columns": table.relevant_columns,
+            "where": table.where,
+            "min_update": table.min_update,
+            "max_update": table.max_update,
+        }
+
+    def start(self, table1: TableSegment, table2: TableSegment):
+        """Records the connections and options of the diff in the journal.
+
+        If the journal already has them, e.g. when resuming, raises ValueError unless they are the same.
+        """
+        header = json.loads(
+            json.dumps({"table1": self._table_header(table1), "table2": self._table_header(table2)}, default=str)
+        )
+        with self._lock, self._conn:
+            res = self._conn.execute("SELECT header FROM journal_header").fetchone()
+            if res is None:
+                self._conn.execute("INSERT INTO journal_header (header) VALUES (?)", (json.dumps(header),))
+                return
+
+        recorded = json.loads(res[0])
+        if recorded != header:
+            changed = [
+                f"{side}.{k}"
+                for side in ("table1", "table2")
+                for k in sorted(set(header[side]) | set(recorded.get(side, {})))
+                if header[side].get(k) != recorded.get(side, {}).get(k)
+            ]
+            raise ValueError(
+                f"The journal {self.path!r} was recorded for a different diff, and can't be resumed. "
+                f"Changed: {', '.join(changed)}"
+            )
+
+    @staticmethod
+    def _segments_key(table1: TableSegment, table2: TableSegment) -> str:
+        return json.dumps([segment_key(table1, 1), segment_key(table2, 2)])
+
+    def get(self, table1: TableSegment, table2: TableSegment) -> Optional[Tuple[Dict[int, int], List[tuple]]]:
+        "Returns the rowcounts and the differences of the segment, or None if it wasn't completed"
+        with self._lock:
+            res = self._conn.execute(
+                "SELECT count1, count2, diff FROM completed_segments WHERE segment = ?",
+                (self._segments_key(table1, table2),),
+            ).fetchone()
+
+        if res is None:
+            return None
+        count1, count2, diff = res
+        return {1: count1, 2: count2}, [(sign, tuple(values)) for sign, values in json.loads(diff)]
+
+    def put(self, table1: TableSegment, table2: TableSegment, rowcounts: Dict[int, int], diff: List[tuple]):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completed_segments (segment, count1, count2, diff) VALUES (?, ?, ?, ?)",
+                (
+                    self._segments_key(table1, table2),
+                    rowcounts[1],
+                    rowcounts[2],
+                    json.dumps([[sign, list(values)] for sign, values in diff], default=str),
+                ),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -92,7 +92,7 @@ class LexicographicSpace:
 
     def _divide(self, v: Vector, count: int):
         n = 0
-        for x, d in zip(v, self.dims[1:] + (1,), strict=True):
+        for x, d in safezip(v, self.dims[1:] + (1,)):
             x += n
             rem = x % count
             n = rem * d
@@ -101,6 +101,27 @@ class LexicographicSpace:
     def divide(self, v: Vector, count: int) -> Vector:
         return tuple(self._divide(v, count))
 
+    def to_index(self, v: Vector) -> int:
+        """Returns the position of v in the lexicographic order of the space.
+
+        Also accepts the end of the space, i.e. (dims[0], 0, 0, ...), whose index is the size of the space.
+        """
+        n = 0
+        for i, d in safezip(v, self.dims):
+            n = n * d + i
+        return n
+
+    def from_index(self, n: int) -> Vector:
+        "The inverse of to_index()"
+        res = []
+        for d in reversed(self.dims[1:]):
+            n, i = divmod(n, d)
+            res.append(i)
+        if n > self.dims[0] or (n == self.dims[0] and any(res)):
+            raise Overflow("Overflow")
+        res.append(n)
+        return tuple(reversed(res))
+
     def range(self, min_value: Vector, max_value: Vector, count: int):
         assert min_value in self and max_value in self
         count -= 1
@@ -152,6 +173,12 @@ class BoundedLexicographicSpace:
     def sub(self, v1: Vector, v2: Vector) -> Interval:
         return self.uspace.sub(self.to_uspace(v1), self.to_uspace(v2))
 
+    def to_index(self, v: Vector) -> int:
+        return self.uspace.to_index(sub_v(v, self.min_bound))
+
+    def from_index(self, n: int) -> Vector:
+        return add_v(self.uspace.from_index(n), self.min_bound)
+
     def range(self, min_value: Vector, max_value: Vector, count: int):
         return [
             self.from_uspace(v) for v in self.uspace.range(self.to_uspace(min_value), self.to_uspace(max_value), count)
@@ -206,6 +233,13 @@ def test_lex_space():
     r = list(rspace2.range(_one, _seven, 4))
     assert r == [_one, _three, _five, _seven], r
 
+    # Test index
+    assert [decspace.to_index(v) for v in [(0, 0, 0), (4, 5, 2), (10, 0, 0)]] == [0, 452, 1000]
+    assert [decspace.from_index(n) for n in [0, 452, 1000]] == [(0, 0, 0), (4, 5, 2), (10, 0, 0)]
+    assert rspace1.to_index((3, 3)) == 7
+    assert rspace1.from_index(7) == (3, 3)
+    assert rspace1.from_index(36) == (8, 2)  # End of the space
+
     # Test range -
     # For random bounds and min/max values, assert that range() generates steps with uniform distances
     MAX_COLUMNS = 16
@@ -1,9 +1,34 @@
 "Module for query utilities that didn't make it into the query-builder (yet)"
 
+import threading
+import weakref
 from contextlib import suppress
+from typing import Iterator, Sequence
+from uuid import uuid4
 
-from sqeleton.databases import DbPath, QueryError, Oracle
-from sqeleton.queries import table, commit, Expr
+from runtype import dataclass
+
+from sqeleton.databases import DbPath, QueryError, Oracle, PostgreSQL
+from sqeleton.databases.base import Database, ThreadedDatabase
+from sqeleton.queries import table, commit, Expr, Compiler
+from sqeleton.queries.ast_classes import Code, Concat, ExprNode
+
+
+@dataclass
+class RowHash(ExprNode):
+    """The MD5 of the given expressions, as an integer, computed for each row.
+
+    Like Checksum, but without the sum(). Uses the dialect's MD5 mixin, so it evaluates to the same value
+    in every database. The columns are joined with the same separator as Checksum, so that values can't
+    shift between columns without changing the hash.
+    """
+
+    exprs: Sequence[Expr]
+
+    def compile(self, c: Compiler) -> str:
+        exprs = [Code(f"coalesce({c.compile(expr)}, '<null>')") for expr in self.exprs]
+        expr = Concat(exprs, "|") if len(exprs) > 1 else exprs[0]
+        return c.dialect.md5_as_int(c.compile(expr))
 
 
 def _drop_table_oracle(name: DbPath):
@@ -52,3 +77,98 @@ def _append_to_table(path: DbPath, expr: Expr):
 def append_to_table(db, path, expr):
     f = _append_to_table_oracle if isinstance(db, Oracle) else _append_to_table
     db.query(f(path, expr))
+
+
+def _open_cursor(db: Database, conn):
+    if isinstance(db, PostgreSQL) and not conn.autocommit:
+        # A named cursor is kept on the server, and only sends the rows that are fetched
+        return conn.cursor(name=f"data_diff_{uuid4().hex}")
+    return conn.cursor()
+
+
+_stream_connections_lock = threading.Lock()
+_idle_stream_connections = weakref.WeakKeyDictionary()  # Database -> list of idle connections
+
+
+def _close_connections(conns: list):
+    while conns:
+        with suppress(Exception):
+            conns.pop().close()
+
+
+def _borrow_stream_connection(db: ThreadedDatabase):
+    with _stream_connections_lock:
+        conns = _idle_stream_connections.get(db)
+        if conns is None:
+            conns = _idle_stream_connections[db] = []
+            # The idle connections are closed along with the database object
+            weakref.finalize(db, _close_connections, conns)
+        if conns:
+            return conns.pop()
+    return db.create_connection()
+
+
+def _return_stream_connection(db: ThreadedDatabase, conn):
+    try:
+        # End the transaction of the query, so the next one doesn't read from an old snapshot
+        conn.rollback()
+    except Exception:
+        with suppress(Exception):
+            conn.close()
+        return
+
+    with _stream_connections_lock:
+        conns = _idle_stream_connections.get(db)
+        if conns is not None:
+            conns.append(conn)
+            return
+    # The pool was closed while the query ran
+    conn.close()
+
+
+def close_stream_connections(db: Database):
+    "Close the connections that iter_query() keeps open for the given database"
+    with _stream_connections_lock:
+        conns = _idle_stream_connections.pop(db, [])
+    _close_connections(conns)
+
+
+def iter_query(db: Database, expr: Expr, batch_size: int) -> Iterator[tuple]:
+    """Run the query, and yield its rows as they are fetched from a cursor, in batches of `batch_size`.
+
+    Unlike db.query(), the result is never loaded into memory all at once.
+
+    Threaded databases lend a connection for the duration of the query, rather than a worker of the database's
+    threadpool, so that several streams may be consumed side by side without deadlocking. The connections are
+    returned to a pool when the query is done, and reused by the following queries, so there are only as many
+    as there are streams open at the same time. (see close_stream_connections())
+    Databases that expose no connection fall back to db.query().
+    """
+    assert batch_size > 0, batch_size
+
+    if isinstance(db, ThreadedDatabase):
+        conn = _borrow_stream_connection(db)
+        borrowed = True
+    elif hasattr(db, "_conn"):
+        conn = db._conn
+        borrowed = False
+    else:
+        yield from db.query(expr, list)
+        return
+
+    sql_code = Compiler(db).compile(expr)
+    try:
+        c = _open_cursor(db, conn)
+        try:
+            c.execute(sql_code)
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield tuple(row)
+        finally:
+            c.close()
+    finally:
+        if borrowed:
+            _return_stream_connection(db, conn)
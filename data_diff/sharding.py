@@ -0,0 +1,62 @@
+"""Combines the results of a diff that was split into shards (see `shard_count` in :class:`HashDiffer`)
+"""
+
+from numbers import Number
+from typing import Iterable
+
+from .diff_tables import DiffStats
+
+_SUMMED_KEYS = ("rows_A", "rows_B", "exclusive_A", "exclusive_B", "updated", "unchanged", "total")
+
+
+def merge_shard_stats(shard_stats: Iterable[dict]) -> dict:
+    """Merges the stats of all the shards of a diff, into the stats of the whole diff.
+
+    Parameters:
+        shard_stats: The stats of each shard, as returned by :meth:`DiffResultWrapper.get_stats_dict`.
+                     If they have a "shard" entry, of ``[shard_index, shard_count]`` (as printed by the CLI
+                     with `--shard-count` and `--json`), it's used to validate that every shard appears exactly once.
+
+    Returns:
+        A dict in the same format as :meth:`DiffResultWrapper.get_stats_dict`.
+    """
+    shard_stats = list(shard_stats)
+    if not shard_stats:
+        raise ValueError("No shard stats to merge")
+
+    shards = [s["shard"] for s in shard_stats if "shard" in s]
+    if shards:
+        if len(shards) != len(shard_stats):
+            raise ValueError("Some of the stats don't specify their shard")
+        shard_counts = {count for _index, count in shards}
+        if len(shard_counts) != 1:
+            raise ValueError(f"Stats are of different shard counts: {shard_counts}")
+        (shard_count,) = shard_counts
+        indices = sorted(index for index, _count in shards)
+        if indices != list(range(shard_count)):
+            raise ValueError(f"Expected each of the {shard_count} shards exactly once, got shards {indices}")
+
+    merged = {k: sum(s[k] for s in shard_stats) for k in _SUMMED_KEYS}
+
+    extra_stats = {}
+    for s in shard_stats:
+        for k, v in (s.get("stats") or {}).items():
+            if isinstance(v, Number):
+                extra_stats[k] = extra_stats.get(k, 0) + v
+    merged["stats"] = extra_stats
+
+    return merged
+
+
+def get_merged_stats_string(merged: dict) -> str:
+    "Formats the merged stats (see :func:`merge_shard_stats`) like the stats of a single diff"
+    max_rows = max(merged["rows_A"], merged["rows_B"])
+    diff_stats = DiffStats(
+        {"-": merged["exclusive_A"], "+": merged["exclusive_B"], "!": merged["updated"]},
+        merged["rows_A"],
+        merged["rows_B"],
+        merged["unchanged"],
+        1 - merged["unchanged"] / max_rows if max_rows else 0.0,
+        None,
+    )
+    return diff_stats.get_stats_string(merged["stats"])
@@ -1,20 +1,30 @@
 import time
-from typing import List, Tuple
+from typing import Iterator, List, Tuple, Optional
 import logging
-from itertools import product
+from itertools import combinations, product
 
 from runtype import dataclass
 
 from .utils import safezip, Vector
+from .query_utils import iter_query, RowHash
+from .arrow_utils import fetch_arrow
+from .lexicographic_space import BoundedLexicographicSpace
 from sqeleton.utils import ArithString, split_space
 from sqeleton.databases import Database, DbPath, DbKey, DbTime
 from sqeleton.schema import Schema, create_schema
-from sqeleton.queries import Count, Checksum, SKIP, table, this, Expr, min_, max_, Code
+from sqeleton.abcs.database_types import Boolean, ColType_UUID, NumericType, TemporalType
+from sqeleton.queries import Count, Checksum, SKIP, table, this, Expr, min_, max_, Code, and_, or_
+from sqeleton.queries.api import when
+from sqeleton.queries.ast_classes import BinOp, In, Random
 from sqeleton.queries.extras import ApplyFuncAndNormalizeAsString, NormalizeAsString
 
 logger = logging.getLogger("table_segment")
 
 RECOMMENDED_CHECKSUM_DURATION = 20
+KEY_BATCH_SIZE = 512
+
+# Estimated size of a normalized string value, for types whose size is unknown (e.g. text)
+ESTIMATED_STRING_SIZE = 64
 
 
 def split_key_space(min_key: DbKey, max_key: DbKey, count: int) -> List[DbKey]:
@@ -33,6 +43,24 @@ def split_key_space(min_key: DbKey, max_key: DbKey, count: int) -> List[DbKey]:
     return [min_key] + checkpoints + [max_key]
 
 
+def split_key_space_by_sample(min_key: DbKey, max_key: DbKey, count: int, sample: List[DbKey]) -> List[DbKey]:
+    """Like split_key_space(), but places the checkpoints at the quantiles of the given sample of keys,
+    instead of spacing them evenly. Returns fewer checkpoints if the sample doesn't have enough distinct values.
+    """
+    assert min_key < max_key
+
+    values = sorted(v for v in sample if min_key < v < max_key)
+
+    checkpoints = []
+    if values:
+        for i in range(1, count + 1):
+            v = values[len(values) * i // (count + 1)]
+            if not checkpoints or checkpoints[-1] < v:
+                checkpoints.append(v)
+
+    return [min_key] + checkpoints + [max_key]
+
+
 def int_product(nums: List[int]) -> int:
     p = 1
     for n in nums:
@@ -40,6 +68,58 @@ def int_product(nums: List[int]) -> int:
     return p
 
 
+def allocate_split_counts(sizes: List[int], count: int) -> List[int]:
+    """Divides a budget of `count` segments between the dimensions of a compound key.
+
+    Repeatedly splits the dimension whose segments are the widest, relative to its size (spread or cardinality),
+    for as long as the total number of segments stays within the budget. A dimension is never split into more
+    segments than its size.
+
+    Returns the number of segments along each dimension.
+    """
+    segment_counts = [1] * len(sizes)
+    while True:
+        total = int_product(segment_counts)
+        candidates = [
+            i
+            for i, (n, size) in enumerate(safezip(segment_counts, sizes))
+            if n < size and total // n * (n + 1) <= count
+        ]
+        if not candidates:
+            return segment_counts
+
+        widest = max(candidates, key=lambda i: sizes[i] / segment_counts[i])
+        segment_counts[widest] += 1
+
+
+def estimate_value_size(col_type) -> int:
+    "Estimates the size in bytes of a value of the given type, once normalized into a string for downloading"
+    if isinstance(col_type, Boolean):
+        return 1
+    if isinstance(col_type, ColType_UUID):
+        return 36
+    if isinstance(col_type, TemporalType):
+        return 26  # e.g. 2022-01-01 00:00:00.000000
+    if isinstance(col_type, NumericType):
+        return 20 + getattr(col_type, "precision", 0)
+    return ESTIMATED_STRING_SIZE
+
+
+def _lexicographic_ge(columns: List[str], values: Vector) -> Expr:
+    # Each comparison gets its own column expression, since an expression can only be resolved once
+    (c, *rest_columns), (v, *rest_values) = columns, values
+    if not rest_columns:
+        return this[c] >= v
+    return or_(this[c] > v, and_(this[c] == v, _lexicographic_ge(rest_columns, rest_values)))
+
+
+def _lexicographic_lt(columns: List[str], values: Vector) -> Expr:
+    (c, *rest_columns), (v, *rest_values) = columns, values
+    if not rest_columns:
+        return this[c] < v
+    return or_(this[c] < v, and_(this[c] == v, _lexicographic_lt(rest_columns, rest_values)))
+
+
 def split_compound_key_space(mn: Vector, mx: Vector, count: int) -> List[List[DbKey]]:
     """Returns a list of split-points for each key dimension, essentially returning an N-dimensional grid of split points."""
     return [split_key_space(mn_k, mx_k, count) for mn_k, mx_k in safezip(mn, mx)]
@@ -82,6 +162,40 @@ def create_mesh_from_points(*values_per_dim: list) -> List[Tuple[Vector, Vector]
     return res
 
 
+def _merge_boxes(box1: Tuple[Vector, Vector], box2: Tuple[Vector, Vector]) -> Optional[Tuple[Vector, Vector]]:
+    (mn1, mx1), (mn2, mx2) = box1, box2
+    differing = [i for i in range(len(mn1)) if (mn1[i], mx1[i]) != (mn2[i], mx2[i])]
+    if len(differing) != 1:
+        return None
+
+    (i,) = differing
+    if mx1[i] != mn2[i] and mx2[i] != mn1[i]:
+        return None  # Not adjacent
+
+    mn = Vector(min(mn1[i], mn2[i]) if j == i else v for j, v in enumerate(mn1))
+    mx = Vector(max(mx1[i], mx2[i]) if j == i else v for j, v in enumerate(mx1))
+    return mn, mx
+
+
+def merge_adjacent_boxes(boxes: List[Tuple[Vector, Vector]]) -> List[Tuple[Vector, Vector]]:
+    """Merges boxes that share a whole face (i.e. that are the same along every dimension but one,
+    where they touch), until no more boxes can be merged. The merged boxes cover the same space.
+    """
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i, j in combinations(range(len(boxes)), 2):
+            box = _merge_boxes(boxes[i], boxes[j])
+            if box is not None:
+                boxes[i] = box
+                del boxes[j]
+                merged = True
+                break
+
+    return boxes
+
+
 @dataclass
 class TableSegment:
     """Signifies a segment of rows (and selected columns) within a table
@@ -98,6 +212,9 @@ class TableSegment:
         min_update (:data:`DbTime`, optional): Lowest update_column value, used to restrict the segment
         max_update (:data:`DbTime`, optional): Highest update_column value, used to restrict the segment
         where (str, optional): An additional 'where' expression to restrict the search space.
+        lex_min (:data:`Vector`, optional): Lowest key value, in lexicographic order, used to further restrict
+                                            the segment within min_key..max_key. Must be set along with `lex_max`.
+        lex_max (:data:`Vector`, optional): Highest key value (exclusive), in lexicographic order.
 
         case_sensitive (bool): If false, the case of column names will adjust according to the schema. Default is true.
 
@@ -118,9 +235,12 @@ class TableSegment:
     min_update: DbTime = None
     max_update: DbTime = None
     where: str = None
+    lex_min: Vector = None
+    lex_max: Vector = None
 
     case_sensitive: bool = True
     _schema: Schema = None
+    _key_sample: list = None  # Sorted sample of the keys, see with_key_sample()
 
     def __post_init__(self):
         if not self.update_column and (self.min_update or self.max_update):
@@ -129,6 +249,11 @@ class TableSegment:
         if self.min_key is not None and self.max_key is not None and self.min_key >= self.max_key:
             raise ValueError(f"Error: min_key expected to be smaller than max_key! ({self.min_key} >= {self.max_key})")
 
+        if (self.lex_min is None) != (self.lex_max is None):
+            raise ValueError("Error: lex_min and lex_max must be set together.")
+        if self.lex_min is not None and not tuple(self.lex_min) < tuple(self.lex_max):
+            raise ValueError(f"Error: lex_min expected to be smaller than lex_max! ({self.lex_min} >= {self.lex_max})")
+
         if self.min_update is not None and self.max_update is not None and self.min_update >= self.max_update:
             raise ValueError(
                 f"Error: min_update expected to be smaller than max_update! ({self.min_update} >= {self.max_update})"
@@ -158,6 +283,15 @@ class TableSegment:
         if self.max_key is not None:
             for k, mx in safezip(self.key_columns, self.max_key):
                 yield this[k] < mx
+        if self.lex_min is not None:
+            # Bounding the leading column on its own lets the database use it to seek on a composite index
+            k = self.key_columns[0]
+            yield self.lex_min[0] <= this[k]
+            yield this[k] <= self.lex_max[0]
+            # Expanded form of (k1, k2, ...) >= lex_min AND (k1, k2, ...) < lex_max, since not every
+            # database supports comparing row values
+            yield _lexicographic_ge(self.key_columns, self.lex_min)
+            yield _lexicographic_lt(self.key_columns, self.lex_max)
 
     def _make_update_range(self):
         if self.min_update is not None:
@@ -174,26 +308,159 @@ class TableSegment:
             *self._make_key_range(), *self._make_update_range(), Code(self._where()) if self.where else SKIP
         )
 
-    def get_values(self) -> list:
+    def _make_values_select(self, order_by_key: bool):
+        select = self.make_select()
+        if not order_by_key:
+            return select.select(*self._relevant_columns_repr)
+
+        # Sort by the raw key columns, not by their normalized strings. The values are aliased, so that the
+        # key names in ORDER BY can't bind to the output columns (which some databases, like PostgreSQL, prefer)
+        values = {f"_value{i}": c for i, c in enumerate(self._relevant_columns_repr)}
+        return select.order_by(*[this[k] for k in self.key_columns]).select(**values)
+
+    def get_values(self, order_by_key: bool = False) -> list:
         "Download all the relevant values of the segment from the database"
-        select = self.make_select().select(*self._relevant_columns_repr)
-        return self.database.query(select, List[Tuple])
+        return self.database.query(self._make_values_select(order_by_key), List[Tuple])
+
+    def get_row_hashes(self) -> List[Tuple[tuple, int]]:
+        """Download the key of each row in the segment, along with a hash of all its relevant columns.
+
+        Returns a list of (key, hash) pairs, where the key is a tuple of normalized strings, like in get_values().
+        """
+        key_count = len(self.key_columns)
+        # Each expression can only be resolved once, so the keys and the hash get their own
+        keys = self._relevant_columns_repr[:key_count]
+        q = self.make_select().select(*keys, RowHash(self._relevant_columns_repr))
+        return [(tuple(row[:key_count]), int(row[key_count])) for row in self.database.query(q, List[Tuple])]
+
+    def get_values_by_keys(self, keys: List[tuple], batch_size: int = KEY_BATCH_SIZE) -> list:
+        """Download the relevant values of the rows with the given keys, in batches of `batch_size` keys.
+
+        The keys are given as tuples of normalized strings, as returned by get_values() and get_row_hashes().
+        """
+        key_types = [self._schema[k] for k in self.key_columns]
+        rows = []
+        for i in range(0, len(keys), batch_size):
+            batch = [[kt.make_value(v) for kt, v in safezip(key_types, key)] for key in keys[i : i + batch_size]]
+            if len(self.key_columns) == 1:
+                (k,) = self.key_columns
+                cond = In(this[k], [key[0] for key in batch])
+            else:
+                cond = or_(*[and_(*[this[k] == v for k, v in safezip(self.key_columns, key)]) for key in batch])
+
+            q = self.make_select().where(cond).select(*self._relevant_columns_repr)
+            rows += self.database.query(q, List[Tuple])
+        return rows
+
+    def get_values_arrow(self):
+        "Like get_values(), but returns the values as a pyarrow.Table. See arrow_utils.supports_arrow()"
+        return fetch_arrow(self.database, self._make_values_select(False))
+
+    def iter_values(self, batch_size: int, order_by_key: bool = False) -> Iterator[tuple]:
+        """Like get_values(), but streams the values from a database cursor, fetching `batch_size` rows at a time.
+
+        The query only starts when the iterator is first consumed.
+        """
+        return iter_query(self.database, self._make_values_select(order_by_key), batch_size)
 
     def choose_checkpoints(self, count: int) -> List[List[DbKey]]:
         "Suggests a bunch of evenly-spaced checkpoints to split by, including start, end."
 
         assert self.is_bounded
 
-        # Take Nth root of count, to approximate the appropriate box size
-        count = int(count ** (1 / len(self.key_columns))) or 1
+        if len(self.key_columns) == 1:
+            return split_compound_key_space(self.min_key, self.max_key, count)
+
+        # Share the segments between the dimensions according to their spread, so that a narrow dimension
+        # (e.g. a tenant_id with a handful of values) doesn't produce a lot of empty boxes
+        sizes = list(self.max_key - self.min_key)
+        return [
+            split_key_space(mn, mx, n - 1) if n > 1 else [mn, mx]
+            for mn, mx, n in safezip(self.min_key, self.max_key, allocate_split_counts(sizes, count + 1))
+        ]
+
+    def with_key_sample(self, sample_size: int) -> "TableSegment":
+        """Returns a new instance of TableSegment, with a random sample of `sample_size` keys from the segment.
+
+        The segments created by segment_by_checkpoints() inherit the sample, so that choose_checkpoints_by_sampling()
+        can split them all without sampling the table again.
+        """
+        select = self.make_select().select(*[NormalizeAsString(this[k]) for k in self.key_columns])
+        sample = self.database.query(select.order_by(Random()).limit(sample_size), list)
 
-        return split_compound_key_space(self.min_key, self.max_key, count)
+        key_types = [self._schema[k] for k in self.key_columns]
+        keys = sorted(Vector(kt.make_value(v) for kt, v in safezip(key_types, row)) for row in sample)
+        return self.new(_key_sample=keys)
+
+    def choose_checkpoints_by_sampling(self, count: int) -> List[List[DbKey]]:
+        """Suggests a bunch of checkpoints to split by, including start, end.
+
+        The checkpoints are placed at the quantiles of the sampled keys (see with_key_sample()) that fall within
+        the segment, so each segment should hold about the same number of rows, even when the keys are skewed
+        or have big gaps. When too few of them do, the checkpoints are evenly spaced instead.
+        """
+
+        assert self.is_bounded
+        assert self._key_sample is not None
+
+        sample = [
+            key
+            for key in self._key_sample
+            if all(mn <= v < mx for v, mn, mx in safezip(key, self.min_key, self.max_key))
+        ]
+        if len(sample) <= count:
+            return self.choose_checkpoints(count)
+
+        sample_per_dim = [[key[i] for key in sample] for i in range(len(self.key_columns))]
+
+        if len(self.key_columns) == 1:
+            segment_counts = [count + 1]
+        else:
+            # Share the segments between the dimensions according to their cardinality in the sample
+            segment_counts = allocate_split_counts([len(set(values)) for values in sample_per_dim], count + 1)
+
+        checkpoints = [
+            split_key_space_by_sample(mn, mx, n - 1, values)
+            for mn, mx, n, values in safezip(self.min_key, self.max_key, segment_counts, sample_per_dim)
+        ]
+        if all(len(c) == 2 for c in checkpoints):
+            # Sample was too small to split by; fall back to evenly spaced checkpoints
+            return self.choose_checkpoints(count)
+
+        return checkpoints
 
     def segment_by_checkpoints(self, checkpoints: List[List[DbKey]]) -> List["TableSegment"]:
         "Split the current TableSegment to a bunch of smaller ones, separated by the given checkpoints"
 
         return [self.new_key_bounds(min_key=s, max_key=e) for s, e in create_mesh_from_points(*checkpoints)]
 
+    @property
+    def is_lexicographic(self) -> bool:
+        return self.lex_min is not None
+
+    def lexicographic_space(self) -> BoundedLexicographicSpace:
+        "The lexicographic space of the keys within min_key..max_key. Requires integer keys."
+        assert self.is_bounded
+        return BoundedLexicographicSpace(self.min_key, self.max_key)
+
+    def with_lexicographic_bounds(self) -> "TableSegment":
+        "Returns a new instance of TableSegment, whose lexicographic bounds span its whole key space"
+        assert self.is_bounded
+        end = Vector((self.max_key[0], *self.min_key[1:]))
+        return self.replace(lex_min=self.min_key, lex_max=end)
+
+    def choose_lexicographic_checkpoints(self, count: int) -> List[Vector]:
+        """Suggests a bunch of checkpoints, evenly spaced in lexicographic order between lex_min and lex_max,
+        including start, end."""
+        assert self.is_lexicographic
+        space = self.lexicographic_space()
+        indices = split_key_space(space.to_index(self.lex_min), space.to_index(self.lex_max), count)
+        return [Vector(space.from_index(i)) for i in indices]
+
+    def segment_by_lexicographic_checkpoints(self, checkpoints: List[Vector]) -> List["TableSegment"]:
+        "Split the current TableSegment to a bunch of smaller ones, each one an interval between two checkpoints"
+        return [self.replace(lex_min=s, lex_max=e) for s, e in safezip(checkpoints[:-1], checkpoints[1:])]
+
     def new(self, **kwargs) -> "TableSegment":
         """Creates a copy of the instance using 'replace()'"""
         return self.replace(**kwargs)
@@ -222,15 +489,15 @@ class TableSegment:
     def _relevant_columns_repr(self) -> List[Expr]:
         return [NormalizeAsString(this[c]) for c in self.relevant_columns]
 
+    def estimate_row_size(self) -> int:
+        "Estimates the size in bytes of a downloaded row, according to the types of its relevant columns"
+        return sum(estimate_value_size(self._schema[c]) for c in self.relevant_columns)
+
     def count(self) -> int:
         """Count how many rows are in the segment, in one pass."""
         return self.database.query(self.make_select().select(Count()), int)
 
-    def count_and_checksum(self) -> Tuple[int, int]:
-        """Count and checksum the rows in the segment, in one pass."""
-        start = time.monotonic()
-        q = self.make_select().select(Count(), Checksum(self._relevant_columns_repr))
-        count, checksum = self.database.query(q, tuple)
+    def _check_checksum_duration(self, start: float):
         duration = time.monotonic() - start
         if duration > RECOMMENDED_CHECKSUM_DURATION:
             logger.warning(
@@ -239,10 +506,66 @@ class TableSegment:
                 duration,
             )
 
+    def count_and_checksum(self) -> Tuple[int, int]:
+        """Count and checksum the rows in the segment, in one pass."""
+        start = time.monotonic()
+        q = self.make_select().select(Count(), Checksum(self._relevant_columns_repr))
+        count, checksum = self.database.query(q, tuple)
+        self._check_checksum_duration(start)
+
         if count:
             assert checksum, (count, checksum)
         return count or 0, int(checksum) if count else None
 
+    def count_and_max_update(self) -> Tuple[int, Optional[str]]:
+        """Count the rows in the segment, and find the latest value of update_column, in one pass.
+
+        Much cheaper than a checksum, and used to tell whether the segment might have changed.
+        """
+        assert self.update_column
+        q = self.make_select().select(Count(), ApplyFuncAndNormalizeAsString(this[self.update_column], max_))
+        count, max_update = self.database.query(q, tuple)
+        return count or 0, max_update
+
+    def _make_bucket_expr(self, checkpoints: List[List[DbKey]]) -> Expr:
+        """Returns an expression that evaluates to the index of the segment each row belongs to,
+        in the same order as the segments returned by segment_by_checkpoints()."""
+        bucket = None
+        for k, points in safezip(self.key_columns, checkpoints):
+            inner = points[1:-1]
+            if inner:
+                index = when(this[k] < inner[0]).then(0)
+                for i, p in enumerate(inner[1:], 1):
+                    index = index.when(this[k] < p).then(i)
+                index = index.else_(len(inner))
+            else:
+                index = 0
+
+            # Same ordering as create_mesh_from_points() - the first dimension is the most significant
+            bucket = index if bucket is None else BinOp("+", [BinOp("*", [bucket, len(points) - 1]), index])
+
+        return bucket
+
+    def count_and_checksum_by_checkpoints(self, checkpoints: List[List[DbKey]]) -> List[Tuple[int, Optional[int]]]:
+        """Count and checksum each of the segments created by segment_by_checkpoints(), in one pass.
+
+        Returns a list of (count, checksum), in the same order as the segments. Empty segments get (0, None).
+        """
+        start = time.monotonic()
+        q = (
+            self.make_select()
+            .group_by(self._make_bucket_expr(checkpoints))
+            .agg(Count(), Checksum(self._relevant_columns_repr))
+        )
+        res = self.database.query(q, list)
+        self._check_checksum_duration(start)
+
+        results = [(0, None)] * int_product(len(p) - 1 for p in checkpoints)
+        for bucket, count, checksum in res:
+            assert checksum, (bucket, count, checksum)
+            results[int(bucket)] = count, int(checksum)
+        return results
+
     def query_key_range(self) -> Tuple[tuple, tuple]:
         """Query database for minimum and maximum key. This is used for setting the initial bounds."""
         # Normalizes the result (needed for UUIDs) after the min/max computation
@@ -267,6 +590,9 @@ class TableSegment:
     def approximate_size(self):
         if not self.is_bounded:
             raise RuntimeError("Cannot approximate the size of an unbounded segment. Must have min_key and max_key.")
+        if self.is_lexicographic:
+            space = self.lexicographic_space()
+            return space.to_index(self.lex_max) - space.to_index(self.lex_min)
         diff = self.max_key - self.min_key
         assert all(d > 0 for d in diff)
         return int_product(diff)
@@ -1,41 +1,107 @@
+import os
 import itertools
+import threading
+import weakref
 from queue import PriorityQueue
 from collections import deque
-from collections.abc import Iterable
-from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures.thread import _WorkItem
-from time import sleep
+from collections.abc import Generator, Iterable
+from concurrent.futures import Executor, Future
 from typing import Callable, Iterator, Optional
 
 
-class AutoPriorityQueue(PriorityQueue):
-    """Overrides PriorityQueue to automatically get the priority from _WorkItem.kwargs
+class _Task:
+    def __init__(self, future: Future, fn: Callable, args, kwargs):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
 
-    We also assign a unique id for each item, to avoid making comparisons on _WorkItem.
-    As a side effect, items with the same priority are returned FIFO.
-    """
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except BaseException as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
 
-    _counter = itertools.count().__next__
 
-    def put(self, item: Optional[_WorkItem], block=True, timeout=None):
-        priority = item.kwargs.pop("priority") if item is not None else 0
-        super().put((-priority, self._counter(), item), block, timeout)
+# Sorts after every task, so that the workers only stop once the queue is drained
+_STOP = (float("inf"), 0, None)
 
-    def get(self, block=True, timeout=None) -> Optional[_WorkItem]:
-        _p, _c, work_item = super().get(block, timeout)
-        return work_item
 
+def _priority_worker(executor_ref: weakref.ref, work_queue: PriorityQueue):
+    # executor_ref is only held so that its callback runs when the executor is garbage-collected
+    while True:
+        item = work_queue.get()
+        task = item[2]
+        if task is None:
+            # Pass it on to the other workers
+            work_queue.put(item)
+            return
+        task.run()
+        del item, task  # Don't keep the call's references alive while waiting
 
-class PriorityThreadPoolExecutor(ThreadPoolExecutor):
-    """Overrides ThreadPoolExecutor to use AutoPriorityQueue
 
-    XXX WARNING: Might break in future versions of Python
-    """
+class PriorityThreadPoolExecutor(Executor):
+    """A pool of threads that runs the submitted calls by order of priority (higher runs first)
 
-    def __init__(self, *args):
-        super().__init__(*args)
+    The priority is given by the keyword argument 'priority' of submit(), which isn't passed on to the call.
+    Calls with the same priority run FIFO.
+    """
 
-        self._work_queue = AutoPriorityQueue()
+    def __init__(self, max_workers: Optional[int] = None):
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        if max_workers <= 0:
+            raise ValueError("max_workers must be greater than 0")
+
+        self._max_workers = max_workers
+        self._work_queue = PriorityQueue()
+        self._threads = set()
+        self._shutdown = False
+        self._lock = threading.Lock()
+        self._counter = itertools.count().__next__
+
+    def submit(self, fn: Callable, *args, priority: int = 0, **kwargs) -> Future:
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+
+            future = Future()
+            self._work_queue.put((-priority, self._counter(), _Task(future, fn, args, kwargs)))
+            self._adjust_thread_count()
+            return future
+
+    def _adjust_thread_count(self):
+        if len(self._threads) >= self._max_workers:
+            return
+
+        # When the executor is garbage-collected, its idle workers are woken up, so they can exit
+        def wake_workers(_, q=self._work_queue):
+            q.put(_STOP)
+
+        t = threading.Thread(target=_priority_worker, args=(weakref.ref(self, wake_workers), self._work_queue))
+        t.daemon = True
+        t.start()
+        self._threads.add(t)
+
+    def shutdown(self, wait: bool = True):
+        "Stop accepting new calls. The workers exit once the calls that were already submitted are done."
+        with self._lock:
+            self._shutdown = True
+            self._work_queue.put(_STOP)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+def submit_with_priority(executor: Executor, fn: Callable, *args, priority: int = 0, **kwargs) -> Future:
+    "Submits the call to the executor, with the given priority if the executor supports it"
+    if isinstance(executor, PriorityThreadPoolExecutor):
+        return executor.submit(fn, *args, priority=priority, **kwargs)
+    return executor.submit(fn, *args, **kwargs)
 
 
 class ThreadedYielder(Iterable):
@@ -43,38 +109,138 @@ class ThreadedYielder(Iterable):
 
     To add a source iterator, call ``submit()`` with a function that returns an iterator.
     Priority for the iterator can be provided via the keyword argument 'priority'. (higher runs first)
+
+    If the iteration stops before all the tasks are done (for example, when the consumer stops early),
+    the yielder is cancelled: tasks that haven't started are dropped, running tasks stop yielding,
+    and new submissions are ignored. Tasks may check ``is_cancelled`` to stop early.
+    The same happens as soon as a task raises an exception, which is then re-raised by the iteration.
+
+    If ``max_buffered`` is given, a task that yields while that many items are waiting for the consumer
+    is blocked until the consumer catches up, so memory use doesn't grow with the consumer's lag.
+    A result that isn't a generator is buffered in one go, so it may overshoot the mark by its length.
+
+    If ``executor`` is given, the tasks run on it instead of on a pool of their own, and it's left running
+    when the yielder is cancelled. That allows many yielders to share a bounded number of threads.
     """
 
-    def __init__(self, max_workers: Optional[int] = None):
-        self._pool = PriorityThreadPoolExecutor(max_workers)
-        self._futures = deque()
+    def __init__(
+        self, max_workers: Optional[int] = None, max_buffered: Optional[int] = None, executor: Optional[Executor] = None
+    ):
+        self._owns_pool = executor is None
+        self._pool = PriorityThreadPoolExecutor(max_workers) if executor is None else executor
+        self._max_buffered = max_buffered
+        self._futures = set()
         self._yield = deque()
+        self._taken = 0  # Items that the consumer took from _yield, but hasn't finished yielding
         self._exception = None
+        self._pending = 0
+        self._cancelled = threading.Event()
+        # Guards the state above. Notified whenever a task yields, fails or finishes, so the consumer never polls.
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        # Notified whenever the consumer takes items, or the yielder is cancelled.
+        self._has_room = threading.Condition(self._lock)
+
+    def _wait_for_room(self):
+        "Blocks while the buffer is at the high-water mark. Must be called with the lock held."
+        if self._max_buffered is None:
+            return
+        while len(self._yield) + self._taken >= self._max_buffered and not self._cancelled.is_set():
+            self._has_room.wait()
 
     def _worker(self, fn, *args, **kwargs):
         try:
+            if self._cancelled.is_set():
+                return
+
             res = fn(*args, **kwargs)
-            if res is not None:
-                self._yield += res
+            if isinstance(res, Generator):
+                try:
+                    for item in res:
+                        with self._cond:
+                            self._wait_for_room()
+                            if self._cancelled.is_set():
+                                break
+                            self._yield.append(item)
+                            self._notify_consumer()
+                finally:
+                    res.close()  # If we stopped early, runs the generator's cleanup, e.g. closing its cursors
+            elif res is not None:
+                with self._cond:
+                    self._wait_for_room()
+                    if self._cancelled.is_set():
+                        return
+                    self._yield += res
+                    self._notify_consumer()
         except Exception as e:
-            self._exception = e
+            with self._cond:
+                is_first = self._exception is None and not self._cancelled.is_set()
+                if is_first:
+                    self._exception = e
+            if is_first:
+                # Fail fast, instead of running the rest of the tasks only to raise afterwards
+                self.cancel()
+        finally:
+            with self._cond:
+                self._pending -= 1
+                self._notify_consumer()
+
+    def _notify_consumer(self):
+        "Called with the lock held, whenever there's something new for the consumer"
+        self._cond.notify()
+
+    def _forget_future(self, future):
+        with self._cond:
+            self._futures.discard(future)
 
     def submit(self, fn: Callable, *args, priority: int = 0, **kwargs):
-        self._futures.append(self._pool.submit(self._worker, fn, *args, priority=priority, **kwargs))
-
-    def __iter__(self) -> Iterator:
-        while True:
-            if self._exception:
-                raise self._exception
-
-            while self._yield:
-                yield self._yield.popleft()
-
-            if not self._futures:
-                # No more tasks
+        with self._cond:
+            if self._cancelled.is_set():
                 return
+            self._pending += 1
+            future = submit_with_priority(self._pool, self._worker, fn, *args, priority=priority, **kwargs)
+            self._futures.add(future)
+        future.add_done_callback(self._forget_future)
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        "Drop all the pending tasks, and signal the running ones to stop."
+        with self._cond:
+            self._cancelled.set()
+            futures = list(self._futures)
+            self._notify_consumer()
+            self._has_room.notify_all()
+        for f in futures:
+            f.cancel()
+        if self._owns_pool:
+            self._pool.shutdown(wait=False)
 
-            if self._futures[0].done():
-                self._futures.popleft()
-            else:
-                sleep(0.001)
+    def __iter__(self) -> Iterator:
+        try:
+            while True:
+                with self._cond:
+                    self._taken = 0
+                    self._has_room.notify_all()
+
+                    while not (self._yield or self._exception or not self._pending):
+                        self._cond.wait()
+
+                    if self._exception:
+                        raise self._exception
+
+                    if not self._yield:
+                        # No more tasks
+                        return
+
+                    items = list(self._yield)
+                    self._yield.clear()
+                    self._taken = len(items)
+
+                yield from items
+        finally:
+            if self._pending:
+                # Stopped before all the tasks were done
+                self.cancel()
@@ -1,6 +1,9 @@
+import json
 import logging
+import os
 import subprocess
 import sys
+import tempfile
 from datetime import datetime, timedelta
 
 from sqeleton.queries import commit, current_timestamp
@@ -69,3 +72,32 @@ class TestCLI(DiffTestCase):
             "1h",
         )
         assert len(diff) == 1, diff
+
+    def test_merge_shards(self):
+        conn_str = CONN_STRINGS[self.db_cls]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            args = []
+            for i in range(2):
+                path = os.path.join(tmpdir, f"shard{i}.jsonl")
+                output = run_datadiff_cli(
+                    conn_str,
+                    self.table_src_name,
+                    conn_str,
+                    self.table_dst_name,
+                    "--json",
+                    "--shard-count",
+                    "2",
+                    "--shard-index",
+                    str(i),
+                )
+                with open(path, "wb") as f:
+                    f.write(b"\n".join(output))
+                args += ["--merge-shards", path]
+
+            merged = [json.loads(line) for line in run_datadiff_cli(*args, "--json")]
+
+        rows = [item for item in merged if isinstance(item, list)]
+        (stats,) = [item for item in merged if isinstance(item, dict)]
+        self.assertEqual(len(rows), 1, merged)
+        self.assertEqual(rows[0][0], "-")
+        self.assertEqual((stats["rows_A"], stats["rows_B"], stats["exclusive_A"]), (5, 4, 1))
@@ -1,17 +1,44 @@
 from datetime import datetime, timedelta
 from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import tempfile
+import threading
 import uuid
 import unittest
+from unittest.mock import patch
 
 from sqeleton.queries import table, this, commit, code
 from sqeleton.utils import ArithAlphanumeric, numberToAlphanum
 
-from data_diff.hashdiff_tables import HashDiffer
+from data_diff import connect, hashdiff_tables
+from data_diff.hashdiff_tables import HashDiffer, BisectionTuner, ConcurrencyController, diff_sets, diff_sorted
+from data_diff.checksum_cache import ChecksumCache
+from data_diff.journal import DiffJournal
+from data_diff.arrow_utils import arrow_exclusive_rows
+from data_diff.async_diff import AsyncHashDiffer, diff_tables_async
+from data_diff import lexicographic_space
 from data_diff.joindiff_tables import JoinDiffer
-from data_diff.table_segment import TableSegment, split_space, Vector
+from data_diff.diff_tables import Scheduling
+from data_diff.sharding import merge_shard_stats
+from data_diff.table_segment import (
+    TableSegment,
+    split_space,
+    split_key_space_by_sample,
+    allocate_split_counts,
+    create_mesh_from_points,
+    merge_adjacent_boxes,
+    Vector,
+)
 from data_diff import databases as db
 
-from .common import str_to_checksum, test_each_database_in_list, DiffTestCase, table_segment
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from .common import str_to_checksum, test_each_database_in_list, DiffTestCase, table_segment, CONN_STRINGS
 
 
 TEST_DATABASES = {
@@ -37,6 +64,200 @@ class TestUtils(unittest.TestCase):
                     r = split_space(i, j + i + n, n)
                     assert len(r) == n, f"split_space({i}, {j+n}, {n}) = {(r)}"
 
+    def test_split_key_space_by_sample(self):
+        # Skewed sample: most of the keys are packed at the start of the range
+        sample = list(range(1, 91)) + list(range(100, 1000000, 100000))
+        r = split_key_space_by_sample(0, 1000000, 3, sample)
+        self.assertEqual(r, [0, 26, 51, 76, 1000000])
+
+        # Not enough distinct values
+        self.assertEqual(split_key_space_by_sample(0, 100, 7, [5, 5, 5]), [0, 5, 100])
+        self.assertEqual(split_key_space_by_sample(0, 100, 7, []), [0, 100])
+
+    def test_merge_adjacent_boxes(self):
+        # The 8 regions around a box in the middle of a 2D space
+        mesh = create_mesh_from_points([0, 10, 20, 30], [0, 10, 20, 30])
+        regions = [(p1, p2) for p1, p2 in mesh if (p1, p2) != (Vector((10, 10)), Vector((20, 20)))]
+        merged = merge_adjacent_boxes(regions)
+        self.assertEqual(len(merged), 4)
+        self.assertEqual(sum((p2 - p1)[0] * (p2 - p1)[1] for p1, p2 in merged), 800)
+
+        # Boxes that only touch at a corner aren't merged
+        corners = [(Vector((0, 0)), Vector((1, 1))), (Vector((1, 1)), Vector((2, 2)))]
+        self.assertEqual(merge_adjacent_boxes(corners), corners)
+
+    def test_lex_space(self):
+        lexicographic_space.test_lex_space()
+
+    def test_allocate_split_counts(self):
+        # A narrow dimension isn't split beyond its size, and the budget goes to the wide one
+        self.assertEqual(allocate_split_counts([5, 10**9], 32), [1, 32])
+        self.assertEqual(allocate_split_counts([10**6, 10**6], 32), [6, 5])
+        self.assertEqual(allocate_split_counts([2, 3], 100), [2, 3])
+        self.assertEqual(allocate_split_counts([10**6], 16), [16])
+
+    @unittest.skipIf(pyarrow is None, "pyarrow not installed")
+    def test_arrow_exclusive_rows(self):
+        t1 = pyarrow.table({"id": ["1", "2", "3", "3"], "x": ["a", None, "c|1:d", "c"]})
+        t2 = pyarrow.table({"id": ["2", "3", "4"], "x": ["", "c|1:d", "d"]})
+        only1, only2 = arrow_exclusive_rows(t1, t2)
+        self.assertEqual(only1, [("1", "a"), ("2", None), ("3", "c")])
+        self.assertEqual(only2, [("2", ""), ("4", "d")])
+
+    def test_shared_task_pool(self):
+        differ = HashDiffer(max_threadpool_size=2)
+        self.assertEqual(differ._thread_map(abs, [-1, -2]), [1, 2])
+        pool = differ._get_task_pool()
+
+        self.assertEqual(list(differ._thread_as_completed(abs, [-3])), [3])
+        with differ._run_in_background(lambda: None) as futures:
+            pass
+        self.assertTrue(all(f.done() for f in futures))
+
+        # All the calls go through the same pool
+        self.assertIs(differ._get_task_pool(), pool)
+
+        # Background tasks run on threads of their own, so they don't hold up the calls, however many there are
+        release = threading.Event()
+        with differ._run_in_background(*[lambda: release.wait(5)] * 5) as futures:
+            self.assertEqual(differ._thread_map(abs, [-4, -5]), [4, 5])
+            self.assertFalse(any(f.done() for f in futures))
+            release.set()
+
+        # Closing shuts down the pool. The differ starts a new one if it's used again.
+        differ.close()
+        self.assertRaises(RuntimeError, pool.submit, abs, -1)
+        with differ:
+            self.assertEqual(differ._thread_map(abs, [-6]), [6])
+            self.assertIsNot(differ._get_task_pool(), pool)
+        self.assertIsNone(differ._task_pool)
+
+    def test_shard_bounds(self):
+        bounds = [HashDiffer(shard_count=3, shard_index=i)._get_shard_bounds(0, 90) for i in range(3)]
+        self.assertEqual(bounds, [(0, 30), (30, 60), (60, 90)])
+
+        # Too few keys to reach the last shards
+        self.assertEqual(HashDiffer(shard_count=3, shard_index=0)._get_shard_bounds(0, 2), (0, 2))
+        self.assertIsNone(HashDiffer(shard_count=3, shard_index=2)._get_shard_bounds(0, 2))
+
+        self.assertRaises(ValueError, HashDiffer, shard_count=3)
+        self.assertRaises(ValueError, HashDiffer, shard_count=3, shard_index=3)
+
+    def test_merge_shard_stats(self):
+        def shard_stats(i, count, n):
+            stats = dict(rows_A=n, rows_B=n + 1, exclusive_A=0, exclusive_B=1, updated=i, unchanged=n - i)
+            return {"shard": [i, count], **stats, "total": 1 + i, "stats": {"rows_downloaded": n, "name": "x"}}
+
+        merged = merge_shard_stats([shard_stats(1, 2, 10), shard_stats(0, 2, 5)])
+        self.assertEqual(
+            merged,
+            {
+                "rows_A": 15,
+                "rows_B": 17,
+                "exclusive_A": 0,
+                "exclusive_B": 2,
+                "updated": 1,
+                "unchanged": 14,
+                "total": 3,
+                "stats": {"rows_downloaded": 15},
+            },
+        )
+
+        self.assertRaises(ValueError, merge_shard_stats, [])
+        self.assertRaises(ValueError, merge_shard_stats, [shard_stats(0, 2, 5)])
+        self.assertRaises(ValueError, merge_shard_stats, [shard_stats(0, 2, 5), shard_stats(0, 2, 5)])
+
+    def test_diff_sorted(self):
+        def key(row):
+            return (int(row[0]),)
+
+        rows1 = [("1", "a"), ("2", "b"), ("4", "d"), ("4", "d"), ("10", "x")]
+        rows2 = [("2", "B"), ("3", "c"), ("4", "d"), ("9", "z"), ("10", "x")]
+        expected = [("-", ("1", "a")), ("-", ("2", "b")), ("+", ("2", "B")), ("+", ("3", "c")), ("+", ("9", "z"))]
+        self.assertEqual(list(diff_sorted(rows1, rows2, key)), expected)
+
+        self.assertRaises(ValueError, list, diff_sorted([("2", "b"), ("1", "a")], [], key))
+
+    def test_encoded_rows(self):
+        rows1 = [("1", "a"), ("2", None), ("3", "c"), ("3", "c"), ("5", "e")]
+        rows2 = [("2", None), ("3", "c"), ("4", ""), ("5", None)]
+        buf1, buf2 = hashdiff_tables._encode_rows(rows1), hashdiff_tables._encode_rows(rows2)
+        self.assertEqual(hashdiff_tables._diff_encoded_rows(buf1, buf2), list(diff_sets(rows1, rows2)))
+
+        # Rows that can't be split back once joined
+        self.assertIsNone(hashdiff_tables._encode_rows([("1", "a\x1fb")]))
+        self.assertIsNone(hashdiff_tables._encode_rows([("1", "a"), ("2\x1e3", "b")]))
+        self.assertIsNone(hashdiff_tables._encode_rows([("1", None), ("2", "\x1d")]))
+        self.assertIsNone(hashdiff_tables._encode_rows([]))
+
+
+class TestBisectionTuner(unittest.TestCase):
+    def test_bisection_tuner(self):
+        tuner = BisectionTuner()
+
+        # Without measurements, use the given values
+        assert tuner.should_download(1000, 0, 2000, 32)
+        assert not tuner.should_download(3000, 0, 2000, 32)
+        self.assertEqual(tuner.choose_factor(10**6, 0, 32), 32)
+
+        # Checksum takes 0.5s, download takes 10us per row; only one segment in 32 is different
+        tuner.record_checksum(1, 0.5)
+        tuner.record_download(10000, 0.1)
+        for i in range(32):
+            tuner.record_segment(1, i == 0)
+
+        assert tuner.should_download(40000, 0, 2000, 32)
+        assert not tuner.should_download(10**6, 0, 2000, 32)
+        self.assertEqual(tuner.choose_factor(90000, 0, 32), 2)
+        self.assertAlmostEqual(tuner.choose_factor(10**7, 0, 32), 200, delta=1)
+        self.assertEqual(tuner.choose_factor(10**9, 0, 32), tuner.max_factor)
+
+
+class TestConcurrencyController(unittest.TestCase):
+    def _run_window(self, controller, key, rows, duration, level=0):
+        for _ in range(controller.window):
+            controller.acquire(key)
+            controller.release(key, duration, rows=rows, level=level)
+
+    def test_aimd(self):
+        controller = ConcurrencyController(max_limit=3, window=2)
+        self.assertEqual(controller.get_limit("a"), 1)
+
+        # Raise the limit while the throughput improves
+        self._run_window(controller, "a", 100, 0.1)
+        self.assertEqual(controller.get_limit("a"), 2)
+        self._run_window(controller, "a", 10**6, 0.1)
+        self.assertEqual(controller.get_limit("a"), 3)
+        self._run_window(controller, "a", 10**9, 0.1)
+        self.assertEqual(controller.get_limit("a"), 3)  # max_limit
+
+        # Each database has its own limit
+        self.assertEqual(controller.get_limit("b"), 1)
+
+        # Back off when the latency rises
+        self._run_window(controller, "a", 10**9, 1.0)
+        self.assertEqual(controller.get_limit("a"), 1)
+
+        # Back off when a query fails
+        self._run_window(controller, "a", 10**9, 1.0)
+        self.assertEqual(controller.get_limit("a"), 2)
+        controller.acquire("a")
+        controller.release("a", 0.1, failed=True)
+        self.assertEqual(controller.get_limit("a"), 1)
+
+    def test_levels(self):
+        controller = ConcurrencyController(max_limit=4, window=2)
+        self._run_window(controller, "a", 10**6, 1.0)
+        self.assertEqual(controller.get_limit("a"), 2)
+
+        # Deeper segments have fewer rows, which isn't a drop in throughput
+        self._run_window(controller, "a", 100, 0.01, level=1)
+        self.assertEqual(controller.get_limit("a"), 3)
+
+        # And the latency of bigger segments is only compared with theirs
+        self._run_window(controller, "a", 10**9, 1.0)
+        self.assertEqual(controller.get_limit("a"), 4)
+
 
 @test_each_database
 class TestDates(DiffTestCase):
@@ -299,6 +520,524 @@ class TestDiffTables(DiffTestCase):
         }
         self.assertEqual(expected, diff)
 
+    def test_diff_bucketed_checksums(self):
+        time = "2022-01-01 00:00:00"
+        time2 = "2021-01-01 00:00:00"
+
+        time_obj = datetime.fromisoformat(time)
+        time_obj2 = datetime.fromisoformat(time2)
+
+        cols = "id userid movieid rating timestamp".split()
+
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 20)], columns=cols),
+                self.dst_table.insert_rows(
+                    [[i, i, i, 9, time_obj2 if i == 7 else time_obj] for i in range(1, 19)], columns=cols
+                ),
+                commit,
+            ]
+        )
+
+        differ = HashDiffer(bisection_factor=3, bisection_threshold=4, bucketed_checksums=True)
+        diff_res = differ.diff_tables(self.table, self.table2)
+        diff = set(diff_res)
+        expected = {
+            ("-", ("7", time + ".000000")),
+            ("+", ("7", time2 + ".000000")),
+            ("-", ("19", time + ".000000")),
+        }
+        self.assertEqual(expected, diff)
+        self.assertEqual(diff_res.info_tree.info.rowcounts, {1: 19, 2: 18})
+
+    def test_diff_quantile_checkpoints(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        cols = "id userid movieid rating timestamp".split()
+        # Skewed keys - most rows are packed into a small part of the key range
+        ids = list(range(1, 30)) + [1000, 100000, 10000000]
+
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in ids], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in ids if i != 17], columns=cols),
+                commit,
+            ]
+        )
+
+        differ = HashDiffer(bisection_factor=3, bisection_threshold=4, quantile_checkpoints=True)
+        with patch.object(
+            TableSegment, "with_key_sample", autospec=True, side_effect=TableSegment.with_key_sample
+        ) as with_key_sample:
+            diff = list(differ.diff_tables(self.table, self.table2))
+        self.assertEqual(diff, [("-", ("17", time + ".000000"))])
+
+        # The keys are sampled once, and the segments below the top of the bisection reuse the sample
+        self.assertEqual(with_key_sample.call_count, 1)
+
+    def test_diff_sorted_merge(self):
+        time = "2022-01-01 00:00:00"
+        time2 = "2021-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+        time_obj2 = datetime.fromisoformat(time2)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 12)], columns=cols),
+                self.dst_table.insert_rows(
+                    [[i, i, i, 9, time_obj2 if i == 10 else time_obj] for i in range(2, 12)], columns=cols
+                ),
+                commit,
+            ]
+        )
+
+        expected = [
+            ("-", ("1", time + ".000000")),
+            ("-", ("10", time + ".000000")),
+            ("+", ("10", time2 + ".000000")),
+        ]
+        for fetch_batch_size in (None, 3):
+            differ = HashDiffer(
+                bisection_factor=2, bisection_threshold=20, sorted_merge=True, fetch_batch_size=fetch_batch_size
+            )
+            # Each segment is merged in key order, but the segments complete in any order
+            diff = list(differ.diff_tables(self.table, self.table2))
+            self.assertEqual(sorted(diff), sorted(expected))
+            self.assertEqual(differ.stats["rows_downloaded"], 11)
+
+        table2 = self.table2.with_schema()
+        values = table2.get_values(order_by_key=True)
+        self.assertEqual([int(row[0]) for row in values], list(range(2, 12)))
+        self.assertEqual(list(table2.iter_values(4, order_by_key=True)), values)
+
+    def test_diff_streamed_segments_reuse_connections(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 41)], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 41) if i % 10], columns=cols),
+                commit,
+            ]
+        )
+
+        created = []
+        create_connection = self.connection.create_connection
+
+        def _create_connection():
+            created.append(create_connection())
+            return created[-1]
+
+        differ = HashDiffer(bisection_factor=4, bisection_threshold=8, sorted_merge=True, fetch_batch_size=3)
+        with patch.object(self.connection, "create_connection", _create_connection), patch.object(
+            TableSegment, "iter_values", autospec=True, side_effect=TableSegment.iter_values
+        ) as iter_values:
+            diff = list(differ.diff_tables(self.table, self.table2))
+
+        self.assertEqual(sorted(diff), sorted(("-", (str(i), time + ".000000")) for i in (10, 20, 30, 40)))
+        # One segment is streamed at a time, from a connection per table, which is reused by the next segments
+        self.assertGreater(iter_values.call_count, 4)
+        self.assertLessEqual(len(created), 2)
+        # The connections are closed when the diff ends
+        self.assertTrue(created)
+        self.assertTrue(all(conn.closed for conn in created))
+
+    def test_diff_one_sided_segments(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 21)], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 11)], columns=cols),
+                commit,
+            ]
+        )
+
+        differ = HashDiffer(bisection_factor=2, bisection_threshold=4)
+        diff = list(differ.diff_tables(self.table, self.table2))
+        expected = [("-", (str(i), time + ".000000")) for i in range(11, 21)]
+        self.assertEqual(sorted(diff), sorted(expected))
+        self.assertEqual(differ.stats["rows_downloaded"], 10)
+
+    def test_diff_one_sided_skewed_segment(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        # Most of the exclusive keys are packed at the start of their range
+        exclusive = list(range(100, 140)) + [10000]
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 11)], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in [*range(1, 11), *exclusive]], columns=cols),
+                commit,
+            ]
+        )
+
+        downloads = []
+        original_get_values = TableSegment.get_values
+
+        def get_values(segment, *args, **kwargs):
+            rows = original_get_values(segment, *args, **kwargs)
+            downloads.append(len(rows))
+            return rows
+
+        differ = HashDiffer(bisection_factor=2, bisection_threshold=8)
+        with patch.object(TableSegment, "get_values", autospec=True, side_effect=get_values):
+            diff_res = differ.diff_tables(self.table, self.table2)
+            diff = list(diff_res)
+
+        self.assertEqual(sorted(diff), sorted(("+", (str(i), time + ".000000")) for i in exclusive))
+        # The pages that got most of the keys were split again
+        self.assertLessEqual(max(downloads), 8)
+        self.assertEqual(sum(downloads), len(exclusive))
+        self.assertEqual(diff_res.info_tree.info.rowcounts, {1: 10, 2: 10 + len(exclusive)})
+
+    def test_diff_download_byte_budget(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 41)], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in range(2, 41)], columns=cols),
+                commit,
+            ]
+        )
+
+        # Room for about 10 rows of (id, timestamp)
+        differ = HashDiffer(bisection_factor=2, download_byte_budget=500)
+        diff = list(differ.diff_tables(self.table, self.table2))
+        self.assertEqual(diff, [("-", ("1", time + ".000000"))])
+        self.assertLess(differ.stats["rows_downloaded"], 20)
+        self.assertGreater(differ.stats["bytes_downloaded"], 0)
+
+    def test_diff_hash_then_fetch(self):
+        time = "2022-01-01 00:00:00"
+        time2 = "2021-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+        time_obj2 = datetime.fromisoformat(time2)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 12)], columns=cols),
+                self.dst_table.insert_rows(
+                    [[i, i, i, 9, time_obj2 if i == 10 else time_obj] for i in range(2, 12)], columns=cols
+                ),
+                commit,
+            ]
+        )
+
+        differ = HashDiffer(bisection_factor=2, bisection_threshold=20, hash_then_fetch=True)
+        diff = list(differ.diff_tables(self.table, self.table2))
+        expected = [
+            ("-", ("1", time + ".000000")),
+            ("-", ("10", time + ".000000")),
+            ("+", ("10", time2 + ".000000")),
+        ]
+        self.assertEqual(sorted(diff), sorted(expected))
+        self.assertEqual(differ.stats["row_hashes_downloaded"], 11)
+        self.assertEqual(differ.stats["rows_downloaded"], 2)
+
+    def test_diff_with_checksum_cache(self):
+        time = "2022-01-01 00:00:00"
+        time2 = "2021-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+        time_obj2 = datetime.fromisoformat(time2)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 20)], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 20) if i != 5], columns=cols),
+                commit,
+            ]
+        )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ChecksumCache(os.path.join(tmpdir, "checksums.sqlite"))
+            expected = [("-", ("5", time + ".000000"))]
+
+            differ = HashDiffer(bisection_factor=3, bisection_threshold=4, checksum_cache=cache)
+            self.assertEqual(list(differ.diff_tables(self.table, self.table2)), expected)
+            assert not differ.stats.get("checksums_from_cache")
+
+            differ = HashDiffer(bisection_factor=3, bisection_threshold=4, checksum_cache=cache)
+            self.assertEqual(list(differ.diff_tables(self.table, self.table2)), expected)
+            assert differ.stats["checksums_from_cache"] > 0
+
+            # New rows invalidate the cached checksums of their segment
+            self.connection.query([self.dst_table.insert_row(12, 12, 12, 9, time_obj2, columns=cols), commit])
+            differ = HashDiffer(bisection_factor=3, bisection_threshold=4, checksum_cache=cache)
+            diff = set(differ.diff_tables(self.table, self.table2))
+            self.assertEqual(diff, set(expected) | {("+", ("12", time2 + ".000000"))})
+            cache.close()
+
+    def test_diff_with_journal(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 30)], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 30) if i % 10], columns=cols),
+                commit,
+            ]
+        )
+        expected = [("-", (str(i), time + ".000000")) for i in (10, 20)]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "journal.sqlite")
+
+            # Interrupt the diff after its first difference
+            differ = HashDiffer(bisection_factor=3, bisection_threshold=4, journal=DiffJournal(path))
+            diff = differ.diff_tables(self.table, self.table2)
+            first = next(iter(diff))
+            diff.close()
+            differ.journal.close()
+
+            differ = HashDiffer(bisection_factor=3, bisection_threshold=4, journal=DiffJournal(path, resume=True))
+            diff = differ.diff_tables(self.table, self.table2)
+            self.assertEqual(sorted(diff), expected)
+            self.assertIn(first, expected)
+            assert differ.stats["segments_resumed"] > 0
+            self.assertEqual(diff.get_stats_dict()["unchanged"], 27)
+            differ.journal.close()
+
+            # Without resume, the journal starts over
+            differ = HashDiffer(bisection_factor=3, bisection_threshold=4, journal=DiffJournal(path))
+            self.assertEqual(sorted(differ.diff_tables(self.table, self.table2)), expected)
+            assert not differ.stats.get("segments_resumed")
+            differ.journal.close()
+
+            # Resuming with other options is refused
+            differ = HashDiffer(bisection_factor=3, bisection_threshold=4, journal=DiffJournal(path, resume=True))
+            with self.assertRaisesRegex(ValueError, "table2.where"):
+                list(differ.diff_tables(self.table, self.table2.replace(where="userid < 20")))
+            differ.journal.close()
+
+    def test_diff_tables_async(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 21)], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in range(2, 21) if i != 15], columns=cols),
+                commit,
+            ]
+        )
+
+        async def diff_both(executor):
+            # Two diffs at once, sharing the executor
+            options = dict(bisection_factor=2, bisection_threshold=4)
+            return await asyncio.gather(
+                self._collect(diff_tables_async(self.table, self.table2, executor, **options)),
+                self._collect(diff_tables_async(self.table2, self.table, executor, **options)),
+            )
+
+        with ThreadPoolExecutor(2) as executor:
+            diff1, diff2 = asyncio.run(diff_both(executor))
+
+        expected = [("-", (str(i), time + ".000000")) for i in (1, 15)]
+        self.assertEqual(sorted(diff1), expected)
+        self.assertEqual(sorted(diff2), [("+", row) for _, row in expected])
+
+        # With a pool for each database, and an executor of its own, which it shuts down when closed
+        async def diff_with_database_pools():
+            async with AsyncHashDiffer(
+                bisection_factor=2, bisection_threshold=4, threaded=True, threads1=2, threads2=2
+            ) as differ:
+                diff = await self._collect(differ.diff_tables_async(self.table, self.table2))
+                return differ, diff, differ._own_executor
+
+        with patch("data_diff.diff_tables.close_stream_connections") as close_stream_connections:
+            differ, diff, executor = asyncio.run(diff_with_database_pools())
+        self.assertEqual(sorted(diff), expected)
+        self.assertEqual(close_stream_connections.call_count, 2)
+        self.assertIsNone(differ._own_executor)
+        self.assertRaises(RuntimeError, executor.submit, print)
+
+    @staticmethod
+    async def _collect(diff):
+        return [d async for d in diff]
+
+    def test_diff_scheduling(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 41)], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 41) if i % 9], columns=cols),
+                commit,
+            ]
+        )
+
+        expected = [("-", (str(i), time + ".000000")) for i in (9, 18, 27, 36)]
+        for scheduling in Scheduling:
+            differ = HashDiffer(bisection_factor=2, bisection_threshold=4, scheduling=scheduling)
+            self.assertEqual(sorted(differ.diff_tables(self.table, self.table2)), sorted(expected))
+
+    def test_diff_database_pools(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 21)], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in range(2, 21)], columns=cols),
+                commit,
+            ]
+        )
+
+        used_pools = []
+        thread_map = HashDiffer._thread_map
+
+        def _thread_map(self, func, iterable):
+            items = list(iterable)
+            pools = self._database_pools_of(items)
+            if pools is not None:
+                used_pools.append(pools)
+            return thread_map(self, func, items)
+
+        differ = HashDiffer(bisection_factor=2, bisection_threshold=4, threads1=1000, threads2=1)
+        with patch.object(HashDiffer, "_thread_map", _thread_map):
+            diff = list(differ.diff_tables(self.table, self.table2))
+        self.assertEqual(diff, [("-", ("1", time + ".000000"))])
+
+        # The pools are sized by the thread count of the database, and shut down when the diff ends
+        thread_count = hashdiff_tables._database_thread_count(self.connection)
+        (pool1, pool2), *others = used_pools
+        self.assertTrue(all(pools == [pool1, pool2] for pools in others))
+        self.assertEqual(pool1._max_workers, thread_count)
+        self.assertEqual(pool2._max_workers, 1)
+        self.assertEqual(differ._database_pools, {})
+        self.assertRaises(RuntimeError, pool1.submit, abs, -1)
+
+        # A diff of another database, at the same time, gets pools of its own, and doesn't end the first one's
+        other = connect(CONN_STRINGS[self.db_cls], thread_count + 1, shared=False)
+        used_pools.clear()
+        with patch.object(HashDiffer, "_thread_map", _thread_map):
+            diff1 = iter(differ.diff_tables(self.table, self.table2))
+            self.assertEqual(next(diff1), ("-", ("1", time + ".000000")))
+            diff2 = list(differ.diff_tables(self.table.replace(database=other), self.table2))
+            self.assertEqual(diff2, [("-", ("1", time + ".000000"))])
+            self.assertEqual(list(diff1), [])
+        other.close()
+
+        pool_sizes = {tuple(pool._max_workers for pool in pools) for pools in used_pools}
+        self.assertEqual(pool_sizes, {(thread_count, 1), (thread_count + 1, 1)})
+        self.assertEqual(differ._database_pools, {})
+
+        # Calls that aren't for the two sides of a diff run on the shared pool
+        self.assertIsNone(differ._database_pools_of([self.table]))
+
+    def test_diff_comparison_processes(self):
+        time = "2022-01-01 00:00:00"
+        time2 = "2021-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+        time_obj2 = datetime.fromisoformat(time2)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 21)], columns=cols),
+                self.dst_table.insert_rows(
+                    [[i, i, i, 9, time_obj2 if i == 7 else time_obj] for i in range(2, 21)], columns=cols
+                ),
+                commit,
+            ]
+        )
+
+        differ = HashDiffer(bisection_factor=2, bisection_threshold=50, comparison_processes=2)
+        # Send even the smallest segments to the worker processes
+        with differ, patch.object(hashdiff_tables, "MIN_ROWS_FOR_COMPARISON_PROCESS", 0):
+            diff = list(differ.diff_tables(self.table, self.table2))
+            pool = differ._comparison_pool
+            self.assertIsNotNone(pool)
+
+        expected = [
+            ("-", ("1", time + ".000000")),
+            ("-", ("7", time + ".000000")),
+            ("+", ("7", time2 + ".000000")),
+        ]
+        # Each segment is compared in order, but the segments complete in any order
+        self.assertEqual(sorted(diff), sorted(expected))
+
+        # The worker processes are shut down with the differ
+        self.assertIsNone(differ._comparison_pool)
+        self.assertRaises(RuntimeError, pool.submit, abs, -1)
+
+    def test_diff_shards(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+
+        cols = "id userid movieid rating timestamp".split()
+        self.connection.query(
+            [
+                self.src_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 41) if i % 7], columns=cols),
+                self.dst_table.insert_rows([[i, i, i, 9, time_obj] for i in range(1, 46) if i % 9], columns=cols),
+                commit,
+            ]
+        )
+
+        full_diff = HashDiffer(bisection_factor=2, bisection_threshold=4).diff_tables(self.table, self.table2)
+        full_stats = full_diff.get_stats_dict()
+
+        shard_diff = []
+        shard_stats = []
+        for i in range(3):
+            differ = HashDiffer(bisection_factor=2, bisection_threshold=4, shard_count=3, shard_index=i)
+            diff = differ.diff_tables(self.table, self.table2)
+            shard_diff += list(diff)
+            shard_stats.append({"shard": [i, 3], **diff.get_stats_dict()})
+
+        # Each difference is found by exactly one shard
+        self.assertEqual(sorted(shard_diff), sorted(full_diff))
+        merged = merge_shard_stats(shard_stats)
+        for k in ("rows_A", "rows_B", "exclusive_A", "exclusive_B", "updated", "unchanged", "total"):
+            self.assertEqual(merged[k], full_stats[k], k)
+
+
+class TestChecksumCacheDatabases(unittest.TestCase):
+    def test_same_table_path_in_two_databases(self):
+        time = "2022-01-01 00:00:00"
+        time_obj = datetime.fromisoformat(time)
+        schema = {"id": int, "rating": float, "timestamp": datetime}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbs = [db.connect({"driver": "duckdb", "filepath": os.path.join(tmpdir, f"db{i}.duckdb")}) for i in (1, 2)]
+            t = table("ratings", schema=schema)
+            for i, conn in enumerate(dbs):
+                rows = [[n, 9 if n != 7 or i == 0 else 8, time_obj] for n in range(1, 20)]
+                conn.query([t.create(), t.insert_rows(rows, columns=list(schema)), commit])
+
+            tables = [table_segment(conn, ("ratings",), "id", "timestamp", ("rating",)) for conn in dbs]
+            cache = ChecksumCache(os.path.join(tmpdir, "checksums.sqlite"))
+            expected = {("-", ("7", time + ".000000", "9.00000")), ("+", ("7", time + ".000000", "8.00000"))}
+
+            # Both tables have the same path, row counts and max(update_column), but not the same checksums
+            for _ in range(2):
+                differ = HashDiffer(bisection_factor=3, bisection_threshold=4, checksum_cache=cache)
+                self.assertEqual(set(differ.diff_tables(*tables)), expected)
+
+            cache.close()
+            for conn in dbs:
+                conn.close()
+
 
 @test_each_database
 class TestDiffTables2(DiffTestCase):
@@ -676,6 +1415,33 @@ class TestConcatMultipleColumnWithNulls(DiffTestCase):
         self.assertEqual(diff, self.diffs)
 
 
+@test_each_database
+class TestRowHashColumnBoundaries(DiffTestCase):
+    src_schema = {"id": str, "c1": str, "c2": str}
+    dst_schema = {"id": str, "c1": str, "c2": str}
+
+    def setUp(self):
+        super().setUp()
+
+        # The same text when concatenated, but split differently between the columns
+        self.connection.query(
+            [
+                self.src_table.insert_rows([("1", "ab", "c")]),
+                self.dst_table.insert_rows([("1", "a", "bc")]),
+                commit,
+            ]
+        )
+
+        self.a = table_segment(self.connection, self.table_src_path, "id", extra_columns=("c1", "c2"))
+        self.b = table_segment(self.connection, self.table_dst_path, "id", extra_columns=("c1", "c2"))
+
+    def test_hash_then_fetch(self):
+        expected = [("-", ("1", "ab", "c")), ("+", ("1", "a", "bc"))]
+        for hash_then_fetch in (False, True):
+            differ = HashDiffer(bisection_factor=2, bisection_threshold=4, hash_then_fetch=hash_then_fetch)
+            self.assertEqual(list(differ.diff_tables(self.a, self.b)), expected)
+
+
 @test_each_database
 class TestTableTableEmpty(DiffTestCase):
     src_schema = {"id": str, "text_comment": str}
@@ -837,6 +1603,10 @@ class TestCompoundKeySimple2(DiffTestCase):
         diff = set(differ.diff_tables(aa, bb))
         self.assertEqual(diff, expected)
 
+        differ = HashDiffer(bisection_factor=4, bisection_threshold=64, lexicographic_segments=True)
+        diff = set(differ.diff_tables(aa, bb))
+        self.assertEqual(diff, expected)
+
 
 @test_each_database
 class TestCompoundKeySimple3(DiffTestCase):
@@ -871,6 +1641,10 @@ class TestCompoundKeySimple3(DiffTestCase):
         diff = set(differ.diff_tables(aa, bb))
         self.assertEqual(diff, expected)
 
+        differ = HashDiffer(bisection_factor=4, bisection_threshold=64, lexicographic_segments=True)
+        diff = set(differ.diff_tables(aa, bb))
+        self.assertEqual(diff, expected)
+
 
 @test_each_database
 class TestCompoundKeyAlphanum(DiffTestCase):
@@ -905,6 +1679,7 @@ class TestCompoundKeyAlphanum(DiffTestCase):
         bb = TableSegment(self.connection, self.dst_table.path, ("id", "id2"), "comment")
         diff = list(differ.diff_tables(aa, bb))
         uuid = diff[0][1][0]
-        self.assertEqual(diff, [("-", (uuid, "9", "9")), ("+", (uuid, "9000", "9"))])
+        # With a compound key, the two rows are in different segments, which may complete in any order
+        self.assertEqual(sorted(diff), sorted([("-", (uuid, "9", "9")), ("+", (uuid, "9000", "9"))]))
 
         self.assertRaises(ValueError, list, differ.diff_tables(aa, a))
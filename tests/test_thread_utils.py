@@ -0,0 +1,122 @@
+import threading
+import time
+import unittest
+from itertools import count, islice
+
+from data_diff.thread_utils import PriorityThreadPoolExecutor, ThreadedYielder
+
+
+class TestPriorityThreadPoolExecutor(unittest.TestCase):
+    def test_priority(self):
+        release = threading.Event()
+        order = []
+
+        pool = PriorityThreadPoolExecutor(1)
+        pool.submit(release.wait, 5)  # Keeps the worker busy, until everything else is queued
+        futures = [pool.submit(order.append, p, priority=p) for p in (1, 3, 2, 3)]
+        futures.append(pool.submit(order.append, 0))
+        release.set()
+        pool.shutdown()
+
+        self.assertEqual(order, [3, 3, 2, 1, 0])
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertRaises(RuntimeError, pool.submit, order.append, 4)
+
+    def test_exception(self):
+        with PriorityThreadPoolExecutor(2) as pool:
+            future = pool.submit(int, "x")
+            self.assertRaises(ValueError, future.result)
+
+
+class TestThreadedYielder(unittest.TestCase):
+    def test_yield_all(self):
+        ti = ThreadedYielder(4)
+        for i in range(10):
+            ti.submit(lambda i: [i, i * 10], i)
+        self.assertEqual(sorted(ti), sorted([i for i in range(10)] + [i * 10 for i in range(10)]))
+        self.assertFalse(ti.is_cancelled)
+
+    def test_cancel_on_early_stop(self):
+        started = []
+        closed = threading.Event()
+
+        def endless():
+            try:
+                yield from count()
+            finally:
+                closed.set()
+
+        ti = ThreadedYielder(1)
+        ti.submit(endless, priority=1)
+        for i in range(10):
+            ti.submit(started.append, i)
+
+        it = iter(ti)
+        self.assertEqual(list(islice(it, 3)), [0, 1, 2])
+        it.close()
+
+        self.assertTrue(ti.is_cancelled)
+        self.assertTrue(closed.wait(5))
+        self.assertEqual(started, [])
+
+        # Submissions after cancelling are ignored
+        ti.submit(started.append, 1)
+        self.assertEqual(started, [])
+
+    def test_nested_submit(self):
+        ti = ThreadedYielder(2)
+
+        def task(depth):
+            if depth:
+                ti.submit(task, depth - 1)
+                ti.submit(task, depth - 1)
+            return [depth]
+
+        ti.submit(task, 4)
+        self.assertEqual(len(list(ti)), 2**5 - 1)
+
+    def test_exception(self):
+        release = threading.Event()
+
+        def fail():
+            raise ValueError("boom")
+
+        ti = ThreadedYielder(2)
+        ti.submit(lambda: [release.wait(5)])
+        ti.submit(fail)
+        # The consumer is woken up by the failure, without waiting for the other task
+        self.assertRaises(ValueError, list, ti)
+        release.set()
+
+    def test_max_buffered(self):
+        produced = []
+
+        def gen():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        ti = ThreadedYielder(2, max_buffered=5)
+        ti.submit(gen)
+        it = iter(ti)
+        self.assertEqual(next(it), 0)
+        time.sleep(0.05)
+        # The producer waits for the consumer, once the buffer is full
+        self.assertLessEqual(len(produced), 5 + 2)
+        self.assertEqual(list(it), list(range(1, 100)))
+
+    def test_fail_fast(self):
+        started = []
+
+        def fail():
+            raise ValueError("boom")
+
+        ti = ThreadedYielder(1)
+        ti.submit(fail, priority=1)
+        for i in range(10):
+            ti.submit(started.append, i)
+
+        self.assertRaises(ValueError, list, ti)
+        self.assertTrue(ti.is_cancelled)
+        # The queued tasks are dropped as soon as the first one fails
+        self.assertEqual(started, [])